@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# from cheap to expensive, every module imports the ones before it
+MODULES = ["tl_core", "tl_widgets", "tl_video", "tl_label"]
+# optional subsystems, they must not show up in the startup imports. QtMultimedia is not among them,
+# the default Video tab loads it as soon as the event loop runs
+LAZY_MODULES = ["PySide6.QtWebEngineWidgets", "pyqtgraph", "cv2", "shapely", "tl_web"]
+
+def run_child(args):
+    # every measurement runs in a fresh interpreter, nothing is imported yet
+    t = time.perf_counter()
+    subprocess.run([sys.executable] + args, cwd=HERE, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - t
+
+def best(args, repeat):
+    return min(run_child(args) for _ in range(repeat))
+
+def first_image(config):
+    # runs in the child: builds the main window and returns once the first image was painted
+    import tl_label
+    from PySide6.QtCore import Qt, QCoreApplication
+    from PySide6.QtWidgets import QApplication
+    QCoreApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
+    app = QApplication(sys.argv[:1])
+    win = tl_label.MainWindow(tl_label.parse_conf(config))
+    win.show()
+    app.processEvents()
+    loaded = sorted(m for m in LAZY_MODULES if m in sys.modules)
+    if loaded:
+        print("Loaded at startup: " + ", ".join(loaded), file=sys.stderr)
+    win.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the cold start time of the labelling tool, each run in a new interpreter")
+    parser.add_argument("--config", type=str, help="tool config, also measures the time until the first image is shown")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--first-image", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.first_image:
+        first_image(args.config)
+        sys.exit(0)
+    base = best(["-c", "pass"], args.repeat)
+    print("{:>12}: {:8.1f} ms".format("interpreter", base * 1000))
+    for m in MODULES:
+        t = best(["-c", "import " + m], args.repeat)
+        print("{:>12}: {:8.1f} ms".format(m, (t - base) * 1000))
+    if args.config:
+        t = best([os.path.abspath(__file__), "--first-image", "--config", os.path.abspath(args.config)], args.repeat)
+        print("{:>12}: {:8.1f} ms".format("first image", (t - base) * 1000))
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import json
+import argparse
+import math
+import collections
+import threading
+import hashlib
+from pathlib import Path
+from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import xdg.BaseDirectory
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+# LabelIO and copy_state are part of the core api of the tool
+from label_io import LabelIO, read_json, copy_state, write_json_atomic
+
+CS_DIR = "/mrtstorage/datasets/public/cityscapes"
+VID_DIR = "/data/cityscapes_videos"
+TL_DIR = "/home/janosovits/cityscapes_labelling/labels_tls/extended-cityscapes-labels/gtFine"
+DEPTH_FILE = "/home/janosovits/cityscapes_labelling/labels_tls/all_boxes.txt"
+DEPTH_PREFIX = "/home/janosovits/cityscapes_labelling/labels_tls/extended-cityscapes-labels"
+
+IMG_SZ = (2048, 1024)
+
+VIDEO_ENDING = "_leftImg8bit.mp4"
+IMG_ENDING = "_leftImg8bit.png"
+LABEL_ENDING = "_gtFine_polygons.json"
+VEHICLE_ENDING = "_vehicle.json"
+TL_CLS = "8"
+
+DISCOVERY_VERSION = 1
+DISCOVERY_THREADS = 16
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str)  # optional flag
+    parsed_args, unparsed_args = parser.parse_known_args()
+    return parsed_args, unparsed_args
+
+def get_conf(args):
+    if args.config:
+        return args.config
+    candidates = []
+    if xdg.BaseDirectory.xdg_config_dirs:
+        for d in xdg.BaseDirectory.xdg_config_dirs:
+            candidate_conf = os.path.join(d, "tl_label.conf")
+            if os.path.exists(candidate_conf):
+                return candidate_conf
+            else:
+                candidates.append(candidate_conf)
+    raise RuntimeError("Config not specified and not available in " + candidates)
+
+def parse_conf(conf_file):
+    config = ConfigParser()
+    config.read(conf_file)
+    c = {
+        "cs_dir": config.get("dirs", "cs_dir"),
+        "vid_dir": config.get("dirs", "vid_dir"),
+        "tl_dir": config.get("dirs", "tl_dir"),
+        "depth_file": config.get("dirs", "depth_file", fallback=DEPTH_FILE),
+        "depth_prefix": config.get("dirs", "depth_prefix", fallback=DEPTH_PREFIX)
+    }
+    return c
+
+def split_fn(fn):
+    split, city, img = fn.split("/")
+    return split, city, Path(img).stem.replace("_leftImg8bit", "")
+
+def extract_lights(json_file):
+    res = {}
+    with open(json_file, "r") as f:
+        root = json.load(f)
+        for idx, obj in enumerate(root["objects"]):
+            if obj["label"] == "traffic light" and not ("deleted" in obj.keys() and int(obj["deleted"]) != 0):
+                res[str(idx)] = obj
+    return res
+
+def default_depth_store(depth_file):
+    name = "depth_{}".format(hashlib.sha1(os.path.abspath(depth_file).encode()).hexdigest()[:16])
+    return os.path.join(xdg.BaseDirectory.xdg_cache_home, "tl_label", name)
+
+def get_gnss(vehicle):
+    return vehicle["gpsLatitude"], vehicle["gpsLongitude"], vehicle["gpsHeading"]
+
+def read_gnss(fn):
+    try:
+        return get_gnss(read_json(fn))
+    except (OSError, ValueError, KeyError):
+        return None
+
+class VehicleTrack():
+    # lat, lon and heading of every image of a city, read once from the vehicle json files
+    def __init__(self, names, gnss):
+        self.names = names
+        self.gnss = gnss
+        self._rows = {n: i for i, n in enumerate(names)}
+
+    @staticmethod
+    def load(city_dir):
+        if not os.path.isdir(city_dir):
+            return VehicleTrack([], np.zeros((0, 3)))
+        with os.scandir(city_dir) as it:
+            files = sorted(e.name for e in it if e.name.endswith(VEHICLE_ENDING))
+        # reading is latency bound on network file systems like the discovery
+        with ThreadPoolExecutor(DISCOVERY_THREADS) as pool:
+            rows = list(pool.map(read_gnss, [os.path.join(city_dir, f) for f in files]))
+        names, gnss = [], []
+        for f, row in zip(files, rows):
+            if row is not None and all(math.isfinite(v) for v in row):
+                names.append(f[:-len(VEHICLE_ENDING)])
+                gnss.append(row)
+        return VehicleTrack(names, np.array(gnss, dtype=np.float64).reshape(-1, 3))
+
+    def __len__(self):
+        return len(self.names)
+
+    def row(self, name):
+        return self._rows.get(name)
+
+    def get(self, name):
+        row = self.row(name)
+        return tuple(self.gnss[row].tolist()) if row is not None else None
+
+def ensure_dir(d):
+    Path(d).parent.mkdir(parents=True, exist_ok=True)
+
+def to_bbox(poly):
+    x, y = zip(*poly)
+    return (min(x), min(y)), (max(x), max(y))
+
+def pad_box(box, padding, img_sz):
+    mmin ,mmax = box
+    return (max(0, mmin[0] - padding), max(0, mmin[1] - padding)), (min(img_sz[0], mmax[0] + padding), min(img_sz[1], mmax[1] + padding))
+
+def default_discovery_cache(img_dir):
+    name = "discovery_{}.json".format(hashlib.sha1(os.path.abspath(img_dir).encode()).hexdigest()[:16])
+    return os.path.join(xdg.BaseDirectory.xdg_cache_home, "tl_label", name)
+
+def list_dirs(d):
+    # name -> mtime of the subdirectories of d
+    with os.scandir(d) as it:
+        return {e.name: e.stat().st_mtime_ns for e in it if e.is_dir()}
+
+def scan_city(city_dir):
+    with os.scandir(city_dir) as it:
+        return sorted(Path(e.name).stem.replace("_leftImg8bit", "") for e in it if e.name.endswith(".png"))
+
+class DataLoader():
+    def __init__(self, cs_dir=CS_DIR, vid_dir=VID_DIR, tl_dir=TL_DIR, cache_file=None):
+        self._cs_dir = cs_dir
+        self._img_dir = os.path.join(cs_dir, "leftImg8bit")
+        self._label_dir = os.path.join(cs_dir, "gtFine")
+        self._vehicle_dir = os.path.join(cs_dir, "vehicle")
+        self._vids_dir = vid_dir
+        self._tl_dir = tl_dir
+        self._cache_file = cache_file if cache_file else default_discovery_cache(self._img_dir)
+        self._available = {}
+        self._positions = {}
+        self._discover()
+        self._init_idx()
+
+    def _read_cache(self):
+        try:
+            cache = read_json(self._cache_file)
+        except (OSError, ValueError):
+            return {}
+        if cache.get("version") != DISCOVERY_VERSION or cache.get("img_dir") != os.path.abspath(self._img_dir):
+            return {}
+        return cache["cities"]
+
+    def _discover(self):
+        # a city directory is only listed again if its mtime changed, i.e. files were added or removed
+        cached = self._read_cache()
+        mtimes = {}
+        for split in list_dirs(self._img_dir):
+            for city_n, mtime in list_dirs(os.path.join(self._img_dir, split)).items():
+                mtimes["{}/{}".format(split, city_n)] = mtime
+        stale = [c for c, m in mtimes.items() if c not in cached or cached[c]["mtime"] != m]
+        # listing is latency bound on network file systems, so the stale cities are listed in parallel
+        with ThreadPoolExecutor(DISCOVERY_THREADS) as pool:
+            scanned = dict(zip(stale, pool.map(scan_city, [os.path.join(self._img_dir, c) for c in stale])))
+        for city, mtime in mtimes.items():
+            keys = scanned[city] if city in scanned else cached[city]["keys"]
+            if keys:
+                self._available[city] = keys
+                self._positions[city] = {k: i for i, k in enumerate(keys)}
+        if stale or set(cached) != set(mtimes):
+            cities = {c: {"mtime": m, "keys": scanned[c] if c in scanned else cached[c]["keys"]} for c, m in mtimes.items()}
+            try:
+                ensure_dir(self._cache_file)
+                write_json_atomic({"version": DISCOVERY_VERSION, "img_dir": os.path.abspath(self._img_dir), "cities": cities}, self._cache_file)
+            except OSError as e:
+                print("Could not write discovery cache {}: {}".format(self._cache_file, e), file=sys.stderr)
+
+    def _init_idx(self):
+        self._cur_city = self.get_cities()[0]
+        self._cur_idx = self._available[self._cur_city][0]
+
+    def set_city(self, city):
+        if not city in self._available.keys():
+            raise ValueError("City " + city + " not found")
+        self._cur_city = city
+        self._cur_idx = self._available[self._cur_city][0]
+
+    def set_idx(self, idx):
+        if not idx in self._positions[self._cur_city]:
+            raise ValueError("Idx " + idx + " not found")
+        self._cur_idx = idx
+
+    def next_img(self):
+        self._cur_idx = self.get_indices()[(self.get_position() + 1) % len(self.get_indices())]
+
+    def prev_img(self):
+        self._cur_idx = self.get_indices()[(self.get_position() - 1) % len(self.get_indices())]
+
+    def get_city(self):
+        return self._cur_city
+
+    def get_cities(self):
+        return sorted(list(self._available.keys()))
+
+    def get_idx(self):
+        return self._cur_idx
+
+    def get_indices(self):
+        return self._available[self.get_city()]
+
+    def get_position(self):
+        return self._positions[self.get_city()][self.get_idx()]
+
+    def _get_stem(self):
+        return "{}/{}".format(self.get_city(), self.get_idx())
+
+    def get_neighbours(self, k):
+        # stems of the k previous and next images of the current city, nearest first
+        indices = self.get_indices()
+        pos = self.get_position()
+        res = []
+        for d in range(1, k + 1):
+            for p in (pos + d, pos - d):
+                if 0 <= p < len(indices):
+                    res.append("{}/{}".format(self.get_city(), indices[p]))
+        return res
+
+    def image_path(self, stem):
+        return os.path.join(self._img_dir, stem + IMG_ENDING)
+
+    def tls_path(self, stem):
+        return os.path.join(self._tl_dir, stem + LABEL_ENDING)
+
+    def vehicle_path(self, stem):
+        return os.path.join(self._vehicle_dir, stem + VEHICLE_ENDING)
+
+    def vehicle_city_dir(self, city):
+        return os.path.join(self._vehicle_dir, city)
+
+    def video_path(self, stem):
+        return os.path.join(self._vids_dir, stem + VIDEO_ENDING)
+
+    def get_video(self):
+        return self.video_path(self._get_stem())
+
+    def get_image(self):
+        return self.image_path(self._get_stem())
+
+    def get_label(self):
+        return os.path.join(self._label_dir, self._get_stem() + LABEL_ENDING)
+
+    def get_tls(self):
+        return self.tls_path(self._get_stem())
+
+    def get_vehicle(self):
+        return self.vehicle_path(self._get_stem())
+
+    def get_depth(self):
+        return DEPTH_FILE
+
+class AsyncWriter():
+    # writes label files on a background thread. Submitting a file that is still queued replaces
+    # the queued state, so a burst of saves of the same file ends up as one write.
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queue = collections.OrderedDict()
+        self._writing = None
+        self._errors = []
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, state):
+        with self._cond:
+            self._queue[fn] = state
+            self._cond.notify_all()
+
+    def latest(self, fn):
+        # the newest state of fn that is not on disk yet, or None
+        with self._cond:
+            if fn in self._queue:
+                return self._queue[fn]
+            if self._writing and self._writing[0] == fn:
+                return self._writing[1]
+            return None
+
+    def take_errors(self):
+        with self._cond:
+            errors, self._errors = self._errors, []
+            return errors
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                self._writing = self._queue.popitem(last=False)
+            fn, state = self._writing
+            try:
+                write_json_atomic(state, fn)
+            except Exception as e:
+                print("Could not write {}: {}".format(fn, e), file=sys.stderr)
+                with self._cond:
+                    self._errors.append((fn, e))
+            with self._cond:
+                self._writing = None
+                self._cond.notify_all()
+
+    def flush(self):
+        with self._cond:
+            while self._queue or self._writing:
+                self._cond.wait()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+class FutureCache():
+    # runs load(key) on worker threads, the futures are kept in a bounded LRU.
+    # Only the UI thread touches the LRU itself.
+    def __init__(self, load, max_entries, threads):
+        self._load = load
+        self._max_entries = max_entries
+        self._pool = ThreadPoolExecutor(threads)
+        self._entries = collections.OrderedDict()
+
+    def request(self, key):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        else:
+            self._entries[key] = self._pool.submit(self._load, key)
+            while len(self._entries) > self._max_entries:
+                _, old = self._entries.popitem(last=False)
+                old.cancel()
+        return self._entries[key]
+
+    def prefetch(self, keys):
+        for key in keys:
+            self.request(key)
+
+    def get(self, key):
+        # blocks only if the entry is not loaded yet
+        return self.request(key).result()
+
+    def invalidate(self, key):
+        old = self._entries.pop(key, None)
+        if old:
+            old.cancel()
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
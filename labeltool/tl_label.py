@@ -1,333 +1,70 @@
 #!/usr/bin/env python3
 
 import sys
-from PySide6.QtCore import QStandardPaths, Qt, Slot, QPoint, QRect, QSize, QLine, QObject, QEvent
-from PySide6.QtGui import QAction, QIcon, QKeySequence, QScreen, QPixmap, QPainter, QPen, QColor, QBrush, QPolygon, QFont
-from PySide6.QtWidgets import (QApplication, QDialog, QFileDialog,
-                               QMainWindow, QSlider, QStyle, QToolBar, QHBoxLayout, QVBoxLayout, QGridLayout, QWidget, QLabel, QComboBox, QGroupBox, QCheckBox, QLayout, QScrollArea, QRadioButton, QPushButton, QStatusBar, QSpinBox, QTabWidget)
-from PySide6.QtMultimedia import (QAudio, QAudioOutput, QMediaFormat,
-                                  QMediaPlayer)
-from PySide6.QtMultimediaWidgets import QVideoWidget
-from PySide6.QtWebEngineWidgets import QWebEngineView
-from PySide6.QtWebEngineCore import QWebEngineProfile
-from PySide6.QtNetwork import QNetworkCookie
-
-import glob
 import os
-from pathlib import Path
-import json
-import re
-import functools
-from shapely.geometry import Polygon, MultiPolygon
-import copy
-import math
-import pyqtgraph as pg
-import numpy as np
-from configparser import ConfigParser
-import os
-import argparse
-import xdg
-
-#from .depth import getDepths
-
-CS_DIR = "/mrtstorage/datasets/public/cityscapes"
-VID_DIR = "/data/cityscapes_videos"
-TL_DIR = "/home/janosovits/cityscapes_labelling/labels_tls/extended-cityscapes-labels/gtFine"
-DEPTH_FILE = "/home/janosovits/cityscapes_labelling/labels_tls/all_boxes.txt"
-DEPTH_PREFIX = "/home/janosovits/cityscapes_labelling/labels_tls/extended-cityscapes-labels"
+from PySide6.QtCore import Qt, Slot, QRect, QTimer, QCoreApplication
+from PySide6.QtGui import QIcon, QPixmap, QImage, QPainter, QPen, QColor, QBrush, QFont
+from PySide6.QtWidgets import (QApplication, QMainWindow, QStyle, QToolBar, QHBoxLayout, QVBoxLayout, QGridLayout, QWidget, QLabel,
+                               QComboBox, QScrollArea, QPushButton, QStatusBar, QTabWidget)
+
+# the data classes live in tl_core and need no Qt, the optional web views are in tl_web and only
+# imported when enabled
+from tl_core import (IMG_SZ, parse_args, get_conf, parse_conf, default_depth_store, to_bbox, pad_box,
+                     VehicleTrack, DataLoader, AsyncWriter, FutureCache, LabelIO, read_json, copy_state)
+import depth_store
+from tl_widgets import (Q_COLOR_DICT, OVERLAY_PEN, get_color, get_color_depth, make_light_shape,
+                        GeoWidget, OverlayWidget, CropWidget)
+from tl_video import decode_frames, ScrubWidget, VideoPanel
 
 SIZE_FACTOR_IMG = 1.0
-IMG_SZ = (2048, 1024)
 
-VIDEO_ENDING = "_leftImg8bit.mp4"
-IMG_ENDING = "_leftImg8bit.png"
-LABEL_ENDING = "_gtFine_polygons.json"
-VEHICLE_ENDING = "_vehicle.json"
-TL_CLS = "8"
+PREFETCH_RANGE = 3
+PREFETCH_THREADS = 4
 
-STATE_DICT = {"R": "red", "RY": "red-yellow", "Y" : "yellow", "G": "green", "O": "off", "U": "unknown"}
-COLOR_DICT = {"R": "salmon", "RY": "orange", "Y": "yellow", "G": "lightgreen", "O": "grey", "U": "lightgrey"}
-TYPE_DICT = {"Car": "car", "Ped": "pedestrian", "Bike": "bicycle", "Train": "train", "Bus": "bus", "CW": "car_warning", "Unk": "unknown"}
-Q_COLOR_DICT = {"red": Qt.red, "red-yellow": Qt.magenta, "yellow": Qt.yellow, "green": Qt.green, "off": Qt.black, "unknown": Qt.gray}
+SCRUB_SNIPPETS = 4
 
 VIZ_DEPTH_TEXT = "Color Depth"
 VIZ_TYPE_TEXT = "Color Attributes"
-
-def parse_args():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-c', '--config', type=str)  # optional flag
-    parsed_args, unparsed_args = parser.parse_known_args()
-    return parsed_args, unparsed_args
-
-def get_conf(args):
-    if args.config:
-        return args.config
-    candidates = []
-    if xdg.BaseDirectory.xdg_config_dirs:
-        for d in xdg.BaseDirectory.xdg_config_dirs:
-            candidate_conf = os.path.join(d, "tl_label.conf")
-            if os.path.exists(candidate_conf):
-                return candidate_conf
-            else:
-                candidates.append(candidate_conf)
-    raise RuntimeError("Config not specified and not available in " + candidates)
-
-def parse_conf(conf_file):
-    config = ConfigParser()
-    config.read(conf_file)
-    c = {
-        "cs_dir": config.get("dirs", "cs_dir"),
-        "vid_dir": config.get("dirs", "vid_dir"),
-        "tl_dir": config.get("dirs", "tl_dir")
-    }
-    return c
-
-def split_fn(fn):
-    split, city, img = fn.split("/")
-    return split, city, Path(img).stem.replace("_leftImg8bit", "")
-
-
-def extract_lights(json_file):
-    res = {}
-    with open(json_file, "r") as f:
-        root = json.load(f)
-        for idx, obj in enumerate(root["objects"]):
-            if obj["label"] == "traffic light" and not ("deleted" in obj.keys() and int(obj["deleted"]) != 0):
-                res[str(idx)] = obj
-    return res
-
-def to_qpolygon(obj):
-    qpoints = [QPoint(p[0], p[1]) for p in obj]
-    return QPolygon.fromList(qpoints)
-
-def ensure_dir(d):
-    Path(d).parent.mkdir(parents=True, exist_ok=True)
-
-def buffer(poly, buffer):
-    p = Polygon(poly)
-    dilated = p.buffer(buffer)
-    if isinstance(dilated, MultiPolygon):
-        dilated = dilated.convex_hull
-    x,y = dilated.exterior.coords.xy
-    res = zip(x,y)
-    return res
-
-def to_bbox(poly):
-    x, y = zip(*poly)
-    return (min(x), min(y)), (max(x), max(y))
-
-def pad_box(box, padding, img_sz):
-    mmin ,mmax = box
-    return (max(0, mmin[0] - padding), max(0, mmin[1] - padding)), (min(img_sz[0], mmax[0] + padding), min(img_sz[1], mmax[1] + padding))
-
-def get_color(attrs, alpha=180):
-    type_lookup = {"car": Qt.cyan, "pedestrian": Qt.green, "bicycle": Qt.yellow, "train": Qt.white, "bus": Qt.white, "unknown": Qt.gray, "car_warning": Qt.cyan}
-    color = type_lookup[attrs["type"]]
-    if attrs["relevant"] == "yes":
-        color = Qt.magenta
-    color = QColor(color)
-    if attrs["visible"] == "no":
-        color = color.darker()
-    color.setAlpha(alpha)
-    return color
-
-def get_color_depth(tl, alpha=180):
-    idx = tl["attributes"]["depth"]
-    colors = [Qt.white, Qt.cyan, Qt.green, Qt.red, Qt.yellow]
-    color = QColor(colors[idx])
-    color.setAlpha(alpha)
-    return color
-
-def to_truth_vec(names, keys):
-    return [True if n in keys else False for n in names]
-
-def get_centroid(poly):
-    return Polygon(poly).centroid.coords[:][0]
-
-def to_bbox(poly):
-    x, y = zip(*poly)
-    return (min(x), min(y)), (max(x), max(y))
-
-class LabelIO():
-    def __init__(self, file):
-        self._file = file
-        self._state = None
-        # self._depth_data = depth_data
-        if not os.path.exists(file):
-            raise RuntimeError("Could not find " + file)
-        with open(file, "r") as f:
-            self._state = json.load(f)
-        self._validate()
-
-    def _set(self, idx, name, value):
-        if self._state["objects"][idx]["label"] != "traffic light":
-            raise ValueError("Idx {} not a traffic light".format(idx))
-        self._state["objects"][idx]["attributes"][name] = value
-
-    def _get(self, idx, name):
-        return self._state["objects"][idx]["attributes"][name]
-
-    def set_type(self, idx, t):
-        self._set(idx, "type", t)
-
-    def set_state(self, idx, t):
-        self._set(idx, "state", t)
-
-    def set_relevant(self, idx):
-        new_val = "yes" if self._get(idx, "relevant") == "no" else "no"
-        self._set(idx, "relevant", new_val)
-
-    def set_lane_relevant(self, idx):
-        new_val = "yes" if self._get(idx, "relevant") == "no" else "no"
-        self._set(idx, "lane_relevant", new_val)
-
-    def set_visible(self, idx):
-        new_val = "yes" if self._get(idx, "visible") == "no" else "no"
-        self._set(idx, "visible", new_val)
-
-    def set_depth(self, idx, depth):
-        self._set(idx, "depth", depth)
-
-    def write(self):
-        with open(self._file, "w") as f:
-            json.dump(self._state, f, indent=4, sort_keys=True, allow_nan=False)
-
-    def get_lights(self):
-        res = {}
-        for idx, obj in enumerate(self._state["objects"]):
-            if obj["label"] == "traffic light" and not ("deleted" in obj.keys() and int(obj["deleted"]) != 0):
-                res[idx] = obj
-                res[idx]["depth_metric"] = self._depth_data[idx] if idx in self._depth_data.keys() else 0
+WEB_MAPS_TEXT = "Web Maps"
+
+class Prefetcher(FutureCache):
+    # decodes images and parses the label json of the neighbouring frames
+    def __init__(self, data, writer=None, max_entries=2 * PREFETCH_RANGE + 2, threads=PREFETCH_THREADS):
+        self._data = data
+        self._writer = writer
+        super().__init__(self._load_stem, max_entries, threads)
+
+    def _load_stem(self, stem):
+        # QImage can be used off the UI thread, QPixmap can not
+        res = {"image": QImage(self._data.image_path(stem)), "labels": None}
+        # a save of this file may still be queued, the file on disk would be outdated then
+        pending = self._writer.latest(self._data.tls_path(stem)) if self._writer else None
+        if pending is not None:
+            res["labels"] = copy_state(pending)
+        elif os.path.exists(self._data.tls_path(stem)):
+            res["labels"] = read_json(self._data.tls_path(stem))
         return res
 
-    def delete_by_idx(self, tl_idx):
-        del self._state["objects"][tl_idx]
-
-    def _validate(self):
-        for idx, l in self.get_lights().items():
-            if not "visible" in l["attributes"]:
-                l["attributes"]["visible"] = "no"
-            if not "relevant" in l["attributes"]:
-                l["attributes"]["relevant"] = "no"
-            if not "state" in l["attributes"]:
-                l["attributes"]["state"] = "unknown"
-            if not "type" in l["attributes"]:
-                l["attributes"]["type"] = "unknown"
-            if not "lane_relevant" in l["attributes"]:
-                if l["attributes"]["relevant"] == "yes":
-                    l["attributes"]["lane_relevant"] = "yes"
-                else:
-                    l["attributes"]["lane_relevant"] = "unknown"
-            if not "depth" in l["attributes"]:
-                l["attributes"]["depth"] = 0
-
-
-class DataLoader():
-    def __init__(self, cs_dir=CS_DIR, vid_dir=VID_DIR, tl_dir=TL_DIR):
-        self._cs_dir = cs_dir
-        self._img_dir = os.path.join(cs_dir, "leftImg8bit")
-        self._label_dir = os.path.join(cs_dir, "gtFine")
-        self._vehicle_dir = os.path.join(cs_dir, "vehicle")
-        self._vids_dir = vid_dir
-        self._tl_dir = tl_dir
-        self._available = {}
-        self._discover()
-        self._init_idx()
-
-    def _discover(self):
-        os.chdir(self._img_dir)
-        imgs = glob.glob("*/*/*.png")
-        for i in imgs:
-            split_n, city_n, key = split_fn(i)
-            city = "{}/{}".format(split_n, city_n)
-            if not city in self._available.keys():
-                self._available[city] = []
-            self._available[city].append(key)
-        for city in self._available.keys():
-            self._available[city].sort()
-
-    def _init_idx(self):
-        self._cur_city = list(self._available.keys())[0]
-        self._cur_idx = self._available[self._cur_city][0]
-
-    def set_city(self, city):
-        if not city in self._available.keys():
-            raise ValueError("City " + city + " not found")
-        self._cur_city = city
-        self._cur_idx = self._available[self._cur_city][0]
-
-    def set_idx(self, idx):
-        if not idx in self._available[self._cur_city]:
-            raise ValueError("Idx " + idx + " not found")
-        self._cur_idx = idx
-
-    def next_img(self):
-        self._cur_idx = self.get_indices()[self.get_indices().index(self._cur_idx) + 1 % len(self.get_indices())]
-
-    def prev_img(self):
-        self._cur_idx = self.get_indices()[self.get_indices().index(self._cur_idx) - 1 % len(self.get_indices())]
-
-    def get_city(self):
-        return self._cur_city
-
-    def get_cities(self):
-        return sorted(list(self._available.keys()))
-
-    def get_idx(self):
-        return self._cur_idx
-
-    def get_indices(self):
-        return self._available[self.get_city()]
-
-    def _get_stem(self):
-        return "{}/{}".format(self.get_city(), self.get_idx())
-
-    def get_video(self):
-        return os.path.join(self._vids_dir, self._get_stem() + VIDEO_ENDING)
-
-    def get_image(self):
-        return os.path.join(self._img_dir, self._get_stem() + IMG_ENDING)
-
-    def get_label(self):
-        return os.path.join(self._label_dir, self._get_stem() + LABEL_ENDING)
-
-    def get_tls(self):
-        return os.path.join(self._tl_dir, self._get_stem() + LABEL_ENDING)
-
-    def get_vehicle(self):
-        return os.path.join(self._vehicle_dir, self._get_stem() + VEHICLE_ENDING)
-
-    def get_depth(self):
-        return DEPTH_FILE
-
-class EventFilter(QObject):
-    def __init__(self, main_window, tl_idx):
-        super().__init__()
-        self.main_window = main_window
-        self.tl_idx = tl_idx
-
-    def eventFilter(self, obj, event):
-        if event.type() == QEvent.Enter:  # Catch the TouchBegin event.
-            self.main_window.set_tl_filter(self.tl_idx)
-            return True
-        elif event.type() == QEvent.Leave:  # Catch the TouchEnd event.
-            self.main_window.remove_tl_filter()
-            return True
-
-        return super().eventFilter(obj, event)
-
 class MainWindow(QMainWindow):
 
     def __init__(self, config):
         super().__init__()
         print("discovering")
         self._data = DataLoader(cs_dir=config["cs_dir"], vid_dir=config["vid_dir"], tl_dir=config["tl_dir"])
+        # all_boxes.txt is converted once, later starts only map the arrays
+        try:
+            self._depths = depth_store.open_store(config["depth_file"], default_depth_store(config["depth_file"]), config["depth_prefix"])
+        except (OSError, ValueError, KeyError) as e:
+            print("Could not load depth file {}, depth_metric will be 0: {}".format(config["depth_file"], e), file=sys.stderr)
+            self._depths = None
+        else:
+            if self._depths is None:
+                print("No depth file {}, depth_metric will be 0".format(config["depth_file"]), file=sys.stderr)
+        self._writer = AsyncWriter()
+        self._prefetcher = Prefetcher(self._data, self._writer)
         print("finished loading")
         self._playlist = []  # FIXME 6.3: Replace by QMediaPlaylist?
         self._playlist_index = -1
-        self._player = QMediaPlayer()
-        self._player.setLoops(10000000)
-        self._player.errorOccurred.connect(self._player_error)
 
         self._label_io = None
         self._draw_stuff = None
@@ -349,6 +86,8 @@ class MainWindow(QMainWindow):
         self._img_widget.setPixmap(self._pixmap)
         self._img_widget.setFixedWidth(2048 * SIZE_FACTOR_IMG)
         self._img_widget.setFixedHeight(1024 * SIZE_FACTOR_IMG)
+        self._overlay = OverlayWidget(self._img_widget)
+        self._tl_shapes = {}
         self._layout_tls.addWidget(self._img_widget)
         self._layout_tls.addLayout(self._layout_checkboxes_plus_space)
         self._layout_checkboxes = QGridLayout()
@@ -377,34 +116,32 @@ class MainWindow(QMainWindow):
         #self._crop_scroll.setFixedHeight(500)
         #self._crop_layout.setSpacing(10)
         self._crops = []
-        self.mouseover_filters = []
+        self._crop_scroll.verticalScrollBar().valueChanged.connect(lambda _: self._load_visible_crops())
         self._layout1.addWidget(self._crop_scroll)
 
         self._tab_widget = QTabWidget()
-        self._video_widget = QVideoWidget()
-        self._video_widget.setFixedWidth(2048)
+        self._video_widget = VideoPanel()
+        self._video_widget.error.connect(self._player_error)
         self._tab_widget.addTab(self._video_widget, "Video")
+        # decoding is cpu bound, one thread keeps the prefetch from competing with the ui
+        self._frame_cache = FutureCache(lambda stem: decode_frames(self._data.video_path(stem)), SCRUB_SNIPPETS, 1)
+        self._scrub_widget = ScrubWidget(self._frame_cache)
+        self._tab_widget.addTab(self._scrub_widget, "Scrub")
 
         self._layout1.addWidget(self._tab_widget)
         self.setCentralWidget(self._main_widget)
-        self._player.setVideoOutput(self._video_widget)
-        self._tab_widget.tabBarClicked.connect(self.tab_changed)
-
-        profile = QWebEngineProfile.defaultProfile()
-        profile.setCachePath("/tmp/qcache")
-        profile.setPersistentStoragePath("~/.qstorage")
-        profile.setPersistentCookiesPolicy(QWebEngineProfile.PersistentCookiesPolicy.ForcePersistentCookies)
-        self._web_widget = QWebEngineView()
-        self._web_widget.setFixedWidth(500)
-        self._web_widget.setUrl("http://maps.google.com/maps?q=&layer=c&cbll=50.93533901728679,6.924794374842279")
-        self._mapillary_widget = QWebEngineView()
-        self._mapillary_widget.setFixedWidth(500)
-        self._mapillary_widget.setUrl("https://www.mapillary.com/app/?lat=47.030860399999995&lng=5.405223299999989&z=17")
-        self._web_page = QWebEngineProfile
+        self._tab_widget.currentChanged.connect(self.tab_changed)
+
+        # every city's track is kept once loaded, switching back never reads the vehicle files again
+        self._geo_cache = FutureCache(lambda city: VehicleTrack.load(self._data.vehicle_city_dir(city)), len(self._data.get_cities()), 1)
+        self._geo_widget = GeoWidget(self._geo_cache)
+        self._geo_widget.track_ready.connect(lambda city: self._update_web_maps())
+        # the web views need QtWebEngine and the network, they are only created when enabled
+        self._web_maps = None
         self.map_layout = QVBoxLayout()
         self._layout1.addLayout(self.map_layout)
-        self.map_layout.addWidget(self._web_widget)
-        self.map_layout.addWidget(self._mapillary_widget)
+        self.map_layout.addWidget(self._geo_widget)
+        self.map_layout.addStretch(1)
 
         self._tl_labels = []
         self._city_changed("train/aachen")
@@ -444,177 +181,138 @@ class MainWindow(QMainWindow):
         reload.triggered.connect(self.on_reload)
         self._viz_depth_action = tool_bar.addAction(VIZ_DEPTH_TEXT)
         self._viz_depth_action.triggered.connect(self.on_viz_depth)
-
-    def _make_crop_widget(self, tl, tl_idx):
-        main = QWidget()
-        main.setMaximumHeight(150)
-        main.setMaximumWidth(460)
-        main.buttons_type = {}
-        main.buttons_state = {}
-        type_button_widget = QWidget()
-        state_button_widget = QWidget()
-        hlayout = QHBoxLayout(main)
-        vlayout = QVBoxLayout()
-        hlayout_top = QHBoxLayout()
-        type_layout = QHBoxLayout(type_button_widget)
-        state_layout = QHBoxLayout(state_button_widget)
-        hlayout_bottom = QHBoxLayout()
-        label = QLabel()
-        #label.setFixedWidth(50)
-        #label.setFixedHeight(100)
-        mmin, mmax = pad_box(to_bbox(tl["polygon"]), 10, IMG_SZ)
-        crop = self._pixmap_clean.copy(QRect(mmin[0], mmin[1], mmax[0] - mmin[0], mmax[1] - mmin[1])).scaled(QSize(100, 200), Qt.KeepAspectRatio)
-        label.setPixmap(crop)
-        fil = EventFilter(self, tl_idx)
-        self.mouseover_filters.append(fil)
-        label.installEventFilter(fil)
-        name = QLabel()
-        name.setText(str(tl_idx))
-        name.setStyleSheet("font-weight: bold")
-        main.spinner = QSpinBox()
-        main.spinner.setValue(tl["attributes"]["depth"])
-        main.spinner.valueChanged[int].connect(functools.partial(self.on_depth, tl_idx))
-        main.spinner.setFixedWidth(50)
-        hlayout_top.addWidget(name)
-        hlayout.addWidget(label)
-        hlayout.addLayout(vlayout)
-        vlayout.addLayout(hlayout_top)
-        vlayout.addWidget(type_button_widget)
-        vlayout.addWidget(state_button_widget)
-        vlayout.addLayout(hlayout_bottom)
-        hlayout_bottom.addWidget(main.spinner)
-        main.del_button = QPushButton("Delete")
-        main.del_button.clicked.connect(functools.partial(self.on_delete, tl_idx))
-        hlayout_top.addWidget(main.del_button)
-        main.visible_button = QCheckBox("Visible")
-        if tl["attributes"]["visible"] == "yes":
-            main.visible_button.setChecked(True)
-        main.visible_button.idx = tl_idx
-        main.visible_button.toggled[bool].connect(functools.partial(self.on_visible, tl_idx))
-        hlayout_top.addWidget(main.visible_button)
-        main.relevant_box = QCheckBox("Relev")
-        if tl["attributes"]["relevant"] == "yes":
-            main.relevant_box.setChecked(True)
-        main.relevant_box.idx = tl_idx
-        main.relevant_box.toggled[bool].connect(functools.partial(self.on_relevant, tl_idx))
-        hlayout_top.addWidget(main.relevant_box)
-        main.lane_relevant_box = QCheckBox("Lane Rel")
-        if tl["attributes"]["lane_relevant"] == "yes":
-            main.lane_relevant_box.setChecked(True)
-        main.lane_relevant_box.idx = tl_idx
-        main.lane_relevant_box.toggled[bool].connect(functools.partial(self.on_lane_relevant, tl_idx))
-        hlayout_top.addWidget(main.lane_relevant_box)
-        for state, s_name in STATE_DICT.items():
-            state_button = QRadioButton(state)
-            state_button.setStyleSheet("background-color: {}".format(COLOR_DICT[state]))
-            state_button.toggled[bool].connect(functools.partial(self.on_state, tl_idx, s_name))
-            if s_name == tl["attributes"]["state"]:
-                state_button.setChecked(True)
-            main.buttons_state[s_name] = state_button
-            state_layout.addWidget(state_button)
-        for t_name, t_val in TYPE_DICT.items():
-            type_button = QRadioButton(t_name)
-            type_button.toggled[bool].connect(functools.partial(self.on_type, tl_idx, t_val))
-            if t_val == tl["attributes"]["type"]:
-                type_button.setChecked(True)
-            main.buttons_state[t_val] = type_button
-            type_layout.addWidget(type_button)
-        return main
+        self._web_maps_action = tool_bar.addAction(WEB_MAPS_TEXT)
+        self._web_maps_action.setCheckable(True)
+        self._web_maps_action.toggled.connect(self.on_web_maps)
 
     def _clear_crops(self):
+        # the widgets stay in _crop_layout for the next image, unused ones are only hidden
         for widget in self._crops:
-            self._layout_checkboxes.removeWidget(widget)
-            widget.deleteLater()
-        del self._crops
-        self._crops = []
-        self.mouseover_filters.clear()
+            widget.unbind()
+            widget.setVisible(False)
         self._tl_filter = None
 
     def _update_crops(self, tls):
         self._clear_crops()
-        for idx, tl in tls.items():
-            tl_widget = self._make_crop_widget(tl, idx)
+        while len(self._crops) < len(tls):
+            tl_widget = CropWidget(self)
             self._crop_layout.addWidget(tl_widget)
             self._crops.append(tl_widget)
+        for tl_widget, (idx, tl) in zip(self._crops, tls.items()):
+            mmin, mmax = pad_box(to_bbox(tl["polygon"]), 10, IMG_SZ)
+            tl_widget.bind(idx, tl, QRect(int(mmin[0]), int(mmin[1]), int(mmax[0] - mmin[0]), int(mmax[1] - mmin[1])))
+            tl_widget.setVisible(True)
+        # the widget positions are only known after the layout ran
+        QTimer.singleShot(0, self._load_visible_crops)
+
+    def _load_visible_crops(self):
+        top = self._crop_scroll.verticalScrollBar().value()
+        bottom = top + self._crop_scroll.viewport().height()
+        for tl_widget in self._crops:
+            if tl_widget.tl_idx is not None and tl_widget.y() < bottom and tl_widget.y() + tl_widget.height() > top:
+                tl_widget.load_crop(self._pixmap_clean)
 
     def _update_video(self):
-        self._player.setSource(self._data.get_video())
-        self._player.play()
+        self._video_widget.play(self._data.get_video())
+
+    def _update_sequence(self):
+        # only the visible tab loads the sequence of the current image
+        current = self._tab_widget.currentWidget()
+        if current is not self._video_widget:
+            self._video_widget.stop()
+        if current is self._scrub_widget:
+            self._scrub_widget.show_stem(self._data._get_stem())
+            self._frame_cache.prefetch(self._data.get_neighbours(1))
+        elif current is self._video_widget:
+            self._update_video()
 
     def _save(self):
-        if self._label_io:
-            self._label_io.write()
-            self._status_bar.showMessage("Wrote {}".format(self._data.get_tls()), 5000)
+        if self._label_io and self._label_io.save(self._writer):
+            self._status_bar.showMessage("Saving {}".format(self._data.get_tls()), 5000)
+        # failed background writes are only reported here, the writer thread can not touch widgets
+        for fn, e in self._writer.take_errors():
+            self._status_bar.showMessage("Could not write {}: {}".format(fn, e))
 
     def _update_idxs_position(self):
-        self._idxs_combo.setCurrentIndex(self._data.get_indices().index(self._data.get_idx()))
+        self._idxs_combo.setCurrentIndex(self._data.get_position())
 
     def _update_idxs_list(self):
         self._idxs_combo.clear()
         self._idxs_combo.insertItems(0, self._data.get_indices())
         self._update_idxs_position()
 
-    def _draw_tls(self, tls):
-        qp = QPainter(self._pixmap)
+    def _draw_tl(self, qp, idx, tl):
+        shape = self._tl_shapes[idx]
+        qp.setBrush(Qt.NoBrush)
+        draw_color = get_color(tl["attributes"]) if self._tl_draw_style == "type" else get_color_depth(tl)
+        qp.setPen(QPen(draw_color, OVERLAY_PEN))
+        qp.drawPolygon(shape["poly"])
+        brushCol = QColor(Q_COLOR_DICT[tl["attributes"]["state"]])
+        brushCol.setAlpha(80)
+        qp.setBrush(QBrush(brushCol, Qt.BrushStyle.SolidPattern))
+        qp.setPen(Qt.NoPen)
+        qp.drawRect(shape["rect"])
+        qp.setPen(QPen(Qt.black, 5))
         qp.setBrush(Qt.NoBrush)
-        qp.setPen(QPen(Qt.red, 5))
+        #qp.drawText(rect, "{} {:.2f}".format(str(idx), tl["depth_metric"]))
+        qp.drawText(shape["rect"], "{}".format(str(idx)))
+
+    def _paint_overlay(self, clip=None):
+        # repaints the lights inside clip, or the whole layer without clip
+        qp = QPainter(self._overlay.layer)
         font = QFont()
         font.setPixelSize(25)
         qp.setFont(font)
-        for idx, tl in tls.items():
-            print(self._tl_filter)
+        if clip is not None:
+            qp.setClipRect(clip)
+        qp.setCompositionMode(QPainter.CompositionMode_Source)
+        qp.fillRect(clip if clip is not None else self._overlay.layer.rect(), Qt.transparent)
+        qp.setCompositionMode(QPainter.CompositionMode_SourceOver)
+        for idx, tl in self._tls.items():
             if self._tl_filter is not None and idx != self._tl_filter:
                 continue
-            qp.setBrush(Qt.NoBrush)
-            draw_color = get_color(tl["attributes"]) if self._tl_draw_style == "type" else get_color_depth(tl)
-            qp.setPen(QPen(draw_color, 5))
-            poly = to_qpolygon(buffer(tl["polygon"], 5))
-            qp.drawPolygon(poly)
-            box = pad_box(to_bbox(tl["polygon"]), 10, IMG_SZ)
-            x = int((box[0][0] + box[1][0]) / 2)
-            if box[0][1] > (IMG_SZ[1] / 2):
-                y = box[0][1] - 20
-            else:
-                y = box[1][1] + 10
-            #rect = QRect(x, y, 150, 25)
-            rect = QRect(x, y, 50, 25)
-            brushCol = QColor(Q_COLOR_DICT[tl["attributes"]["state"]])
-            brushCol.setAlpha(80)
-            qp.setBrush(QBrush(brushCol, Qt.BrushStyle.SolidPattern))
-            qp.setPen(Qt.NoPen)
-            qp.drawRect(rect)
-            qp.setPen(QPen(Qt.black, 5))
-            qp.setBrush(Qt.NoBrush)
-            #qp.drawText(rect, "{} {:.2f}".format(str(idx), tl["depth_metric"]))
-            qp.drawText(rect, "{}".format(str(idx)))
+            if clip is not None and not self._tl_shapes[idx]["bounds"].intersects(clip):
+                continue
+            self._draw_tl(qp, idx, tl)
         qp.end()
+        self._overlay.update(self._overlay.to_widget(clip) if clip is not None else self._overlay.rect())
 
     def _redraw(self):
         if not self._redraw_lock:
-            self._pixmap = self._pixmap_clean.copy()
-            self._draw_tls(self._tls)
-            # self._update_plot(self._tls)
-            self._img_widget.setPixmap(self._pixmap)
+            self._paint_overlay()
+
+    def _light_changed(self, idx):
+        # only the area of the changed light is repainted, overlapping neighbours included
+        if not self._redraw_lock and idx in self._tl_shapes:
+            self._paint_overlay(self._tl_shapes[idx]["bounds"])
 
     def _update_light_state(self):
+        # object indices shift after a delete, so shapes and crops are rebuilt
         self._tls = self._label_io.get_lights()
+        self._tl_shapes = {idx: make_light_shape(tl) for idx, tl in self._tls.items()}
+        self._update_crops(self._tls)
         self._redraw()
 
-    def _labels_changed(self):
-        # depths = self._depths.get_key(self._data._get_stem())
-        self._label_io = LabelIO(self._data.get_tls())
+    def _labels_changed(self, state=None):
+        depths = self._depths.get(self._data._get_stem()) if self._depths else {}
+        self._label_io = LabelIO(self._data.get_tls(), state, depths)
         self._tls = self._label_io.get_lights()
+        self._tl_shapes = {idx: make_light_shape(tl) for idx, tl in self._tls.items()}
         self._update_crops(self._tls)
         self._redraw()
 
     def _image_changed(self):
-        self._pixmap.load(self._data.get_image())
-        self._pixmap_clean = self._pixmap.copy()
-        self._labels_changed()
+        entry = self._prefetcher.get(self._data._get_stem())
+        # the image label shows the clean image, the lights live in the overlay
+        self._pixmap = QPixmap.fromImage(entry["image"])
+        self._pixmap_clean = self._pixmap
+        self._img_widget.setPixmap(self._pixmap)
+        self._labels_changed(entry["labels"])
         self._update_idxs_position()
-        self._update_video()
-        self._web_widget.setUrl(self._get_gmaps())
-        self._mapillary_widget.setUrl(self._get_mapillary())
+        self._update_sequence()
+        self._geo_widget.show_position(self._data.get_city(), self._data.get_idx())
+        self._update_web_maps()
+        self._prefetcher.prefetch(self._data.get_neighbours(PREFETCH_RANGE))
 
     def _set_image(self, idx):
         self._pre_change()
@@ -642,12 +340,10 @@ class MainWindow(QMainWindow):
 
     def _toggle_play(self):
         style = self.style()
-        if self._player.playbackState() == QMediaPlayer.PlayingState:
-            self._player.pause()
+        if not self._video_widget.toggle():
             icon = QIcon.fromTheme("media-playback-start.png", style.standardIcon(QStyle.SP_MediaPlay))
             self._stop_action.setIcon(icon)
         else:
-            self._player.play()
             icon = QIcon.fromTheme("media-playback-stop.png", style.standardIcon(QStyle.SP_MediaStop))
             self._stop_action.setIcon(icon)
 
@@ -668,24 +364,39 @@ class MainWindow(QMainWindow):
         self._tl_filter = None
         self._redraw()
 
-    def _get_gnss(self):
-        with open(self._data.get_vehicle(), "r") as f:
-            root = json.load(f)
-            lat = root["gpsLatitude"]
-            lon = root["gpsLongitude"]
-            yaw = root["gpsHeading"]
-        return lat, lon, yaw
-
-    def _get_gmaps(self):
-        lat, lon, yaw = self._get_gnss()
-        return "http://maps.google.com/maps?q=&layer=c&cbll={},{}&cbp=12,{},0,0,5".format(lat, lon, yaw)
+    def _create_web_maps(self):
+        import tl_web
+        self._web_maps = tl_web.WebMaps()
+        # above the stretch, below the geo panel
+        for i, w in enumerate(self._web_maps.widgets):
+            self.map_layout.insertWidget(i + 1, w)
+
+    def _set_web_maps(self, enabled):
+        if enabled and self._web_maps is None:
+            self._create_web_maps()
+        if self._web_maps is not None:
+            self._web_maps.set_visible(enabled)
+        self._update_web_maps()
+
+    def _update_web_maps(self):
+        # the views only reload if they are shown and the position is known
+        if self._web_maps is None or not self._web_maps_action.isChecked():
+            return
+        gnss = self._geo_widget.gnss()
+        if gnss is None:
+            return
+        self._web_maps.set_position(gnss)
 
-    def _get_mapillary(self):
-        lat, lon, yaw = self._get_gnss()
-        return "https://www.mapillary.com/app/?lat={}&lng={}&z=17".format(lat, lon)
+    def closeEvent(self, event):
+        self._prefetcher.shutdown()
+        self._frame_cache.shutdown()
+        self._geo_cache.shutdown()
+        self._save()
+        self._writer.close()
+        super().closeEvent(event)
 
-    @Slot(QMediaPlayer.Error, str)
-    def _player_error(self, error, error_string):
+    @Slot(str)
+    def _player_error(self, error_string):
         print(error_string, file=sys.stderr)
         self.show_status_message(error_string)
 
@@ -711,41 +422,33 @@ class MainWindow(QMainWindow):
         self._toggle_play()
 
     @Slot()
-    def tab_changed(self, foo):
-        if foo != 0:
-            return
-        self._video_widget.deleteLater()
-        self._tab_widget.removeTab(0)
-        self._video_widget = QVideoWidget()
-        self._video_widget.setFixedWidth(2048)
-        self._update_video()
-        self._player.setVideoOutput(self._video_widget)
-        self._tab_widget.insertTab(0, self._video_widget, "Video")
+    def tab_changed(self, idx):
+        self._update_sequence()
 
     @Slot()
     def on_type(self, tl_idx, new_type, checked):
         self._label_io.set_type(tl_idx, new_type)
-        self._update_light_state()
+        self._light_changed(tl_idx)
 
     @Slot()
     def on_state(self, tl_idx, new_state, checked):
         self._label_io.set_state(tl_idx, new_state)
-        self._update_light_state()
+        self._light_changed(tl_idx)
 
     @Slot()
     def on_visible(self, tl_idx, checked):
         self._label_io.set_visible(tl_idx)
-        self._update_light_state()
+        self._light_changed(tl_idx)
 
     @Slot()
     def on_relevant(self, tl_idx, checked):
         self._label_io.set_relevant(tl_idx)
-        self._update_light_state()
+        self._light_changed(tl_idx)
 
     @Slot()
     def on_lane_relevant(self, tl_idx, checked):
         self._label_io.set_lane_relevant(tl_idx)
-        self._update_light_state()
+        self._light_changed(tl_idx)
 
     @Slot()
     def on_delete(self, tl_idx):
@@ -755,6 +458,7 @@ class MainWindow(QMainWindow):
     @Slot()
     def on_depth(self, tl_idx, depth):
         self._label_io.set_depth(tl_idx, depth)
+        self._light_changed(tl_idx)
 
     @Slot()
     def onCopyStreetviewLinkToClipboard(self):
@@ -766,17 +470,26 @@ class MainWindow(QMainWindow):
 
     @Slot()
     def on_reload(self):
+        # the cached labels may be stale, reload reads the file again once the queued saves are written
+        self._writer.flush()
+        self._prefetcher.invalidate(self._data._get_stem())
         self._labels_changed()
 
     @Slot()
     def on_viz_depth(self):
         self._change_viz_depth()
 
+    @Slot()
+    def on_web_maps(self, checked):
+        self._set_web_maps(checked)
+
 if __name__ == '__main__':
     parsed_args, unparsed_args = parse_args()
     # QApplication expects the first argument to be the program name.
     qt_args = sys.argv[:1] + unparsed_args
     print(parsed_args)
+    # QtWebEngine is imported only when the web maps are enabled, it needs this before the application exists
+    QCoreApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
     app = QApplication(qt_args)
     conf = parse_conf(get_conf(parsed_args))
     main_win = MainWindow(conf)
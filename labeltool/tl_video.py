@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import os
+from PySide6.QtCore import Qt, Signal, QTimer
+from PySide6.QtGui import QPixmap, QImage
+from PySide6.QtWidgets import QWidget, QVBoxLayout, QLabel, QSlider
+
+from tl_core import IMG_SZ
+
+SCRUB_SCALE = 0.5
+# the cityscapes snippets have 30 frames, the annotated image is frame 19
+ANNOTATED_FRAME = 19
+VIDEO_LOOPS = 10000000
+
+def decode_frames(video_file, scale=SCRUB_SCALE):
+    # all frames of a snippet as downscaled QImages, runs on a worker thread
+    import cv2
+    if not os.path.exists(video_file):
+        raise FileNotFoundError("{} does not exist".format(video_file))
+    cap = cv2.VideoCapture(video_file)
+    frames = []
+    try:
+        while True:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            if scale != 1:
+                frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            h, w = frame.shape[:2]
+            # copy, the QImage must not point into the numpy buffer
+            frames.append(QImage(frame.data, w, h, frame.strides[0], QImage.Format_BGR888).copy())
+    finally:
+        cap.release()
+    return frames
+
+class ScrubWidget(QWidget):
+    # frame accurate view of the video snippet around the annotated image
+    frames_ready = Signal(str)
+
+    def __init__(self, cache):
+        super().__init__()
+        self._cache = cache
+        self._stem = None
+        self._frames = []
+        layout = QVBoxLayout(self)
+        self._frame_label = QLabel()
+        self._frame_label.setScaledContents(True)
+        self._frame_label.setFixedSize(int(IMG_SZ[0] * SCRUB_SCALE), int(IMG_SZ[1] * SCRUB_SCALE))
+        self._slider = QSlider(Qt.Horizontal)
+        self._slider.valueChanged[int].connect(self._show_frame)
+        self._info = QLabel()
+        layout.addWidget(self._frame_label)
+        layout.addWidget(self._slider)
+        layout.addWidget(self._info)
+        layout.addStretch(1)
+        # done callbacks run on the worker thread, the signal moves them to the UI thread
+        self.frames_ready.connect(self._on_frames_ready)
+
+    def show_stem(self, stem):
+        if stem == self._stem and self._frames:
+            return
+        self._stem = stem
+        self._frames = []
+        self._slider.setEnabled(False)
+        self._frame_label.clear()
+        self._info.setText("Loading {}".format(stem))
+        self._watch(stem)
+
+    def _watch(self, stem):
+        self._cache.request(stem).add_done_callback(lambda f, stem=stem: self.frames_ready.emit(stem))
+
+    def _on_frames_ready(self, stem):
+        if stem != self._stem:
+            return
+        future = self._cache.request(stem)
+        if not future.done():
+            # the entry was evicted or replaced since, wait for the new future
+            self._watch(stem)
+            return
+        try:
+            self._frames = future.result()
+        except Exception as e:
+            self._info.setText("Could not decode {}: {}".format(stem, e))
+            return
+        if not self._frames:
+            self._info.setText("No frames in {}".format(stem))
+            return
+        self._slider.blockSignals(True)
+        self._slider.setRange(0, len(self._frames) - 1)
+        self._slider.setValue(min(ANNOTATED_FRAME, len(self._frames) - 1))
+        self._slider.blockSignals(False)
+        self._slider.setEnabled(True)
+        self._show_frame(self._slider.value())
+
+    def _show_frame(self, i):
+        if not 0 <= i < len(self._frames):
+            return
+        self._frame_label.setPixmap(QPixmap.fromImage(self._frames[i]))
+        self._info.setText("Frame {} / {}{}".format(i, len(self._frames) - 1, " (annotated)" if i == ANNOTATED_FRAME else ""))
+
+class VideoPanel(QWidget):
+    # plays the video snippet of the current image. QtMultimedia is slow to load, so it is only
+    # imported once the first video is played, after the event loop is running
+    error = Signal(str)
+
+    def __init__(self):
+        super().__init__()
+        self._layout = QVBoxLayout(self)
+        self._player = None
+        self._video_widget = None
+        self._source = None
+
+    def _create_player(self):
+        from PySide6.QtMultimedia import QMediaPlayer
+        from PySide6.QtMultimediaWidgets import QVideoWidget
+        self._video_widget = QVideoWidget()
+        self._video_widget.setFixedWidth(IMG_SZ[0])
+        self._layout.addWidget(self._video_widget)
+        self._player = QMediaPlayer()
+        self._player.setLoops(VIDEO_LOOPS)
+        self._player.errorOccurred.connect(lambda error, error_string: self.error.emit(error_string))
+        self._player.setVideoOutput(self._video_widget)
+
+    def _start(self):
+        if self._source is None:
+            return
+        if self._player is None:
+            self._create_player()
+        self._player.setSource(self._source)
+        self._player.play()
+
+    def play(self, source):
+        first = self._source is None and self._player is None
+        self._source = source
+        if first:
+            QTimer.singleShot(0, self._start)
+        elif self._player is not None:
+            self._start()
+
+    def stop(self):
+        self._source = None
+        if self._player is not None:
+            self._player.stop()
+
+    def toggle(self):
+        # returns whether the video plays afterwards
+        if self._player is None:
+            return False
+        from PySide6.QtMultimedia import QMediaPlayer
+        if self._player.playbackState() == QMediaPlayer.PlayingState:
+            self._player.pause()
+            return False
+        self._player.play()
+        return True
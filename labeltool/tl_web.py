@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+from PySide6.QtWebEngineWidgets import QWebEngineView
+from PySide6.QtWebEngineCore import QWebEngineProfile
+
+WEB_WIDTH = 500
+
+def gmaps_url(gnss):
+    lat, lon, yaw = gnss
+    return "http://maps.google.com/maps?q=&layer=c&cbll={},{}&cbp=12,{},0,0,5".format(lat, lon, yaw)
+
+def mapillary_url(gnss):
+    lat, lon, yaw = gnss
+    return "https://www.mapillary.com/app/?lat={}&lng={}&z=17".format(lat, lon)
+
+class WebMaps():
+    # street view and mapillary of the current position, needs the network
+    def __init__(self):
+        profile = QWebEngineProfile.defaultProfile()
+        profile.setCachePath("/tmp/qcache")
+        profile.setPersistentStoragePath("~/.qstorage")
+        profile.setPersistentCookiesPolicy(QWebEngineProfile.PersistentCookiesPolicy.ForcePersistentCookies)
+        self.widgets = []
+        for _ in range(2):
+            view = QWebEngineView()
+            view.setFixedWidth(WEB_WIDTH)
+            self.widgets.append(view)
+
+    def set_visible(self, visible):
+        for w in self.widgets:
+            w.setVisible(visible)
+
+    def set_position(self, gnss):
+        for w, url in zip(self.widgets, [gmaps_url(gnss), mapillary_url(gnss)]):
+            w.setUrl(url)
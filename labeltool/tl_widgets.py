@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+
+import math
+import functools
+import numpy as np
+from PySide6.QtCore import Qt, Signal, QPoint, QPointF, QRect, QSize, QObject, QEvent
+from PySide6.QtGui import QPixmap, QPainter, QPen, QColor, QBrush, QPolygon, QPolygonF, QPainterPath, QPainterPathStroker
+from PySide6.QtWidgets import QWidget, QHBoxLayout, QVBoxLayout, QLabel, QCheckBox, QRadioButton, QPushButton, QSpinBox
+
+from tl_core import IMG_SZ, to_bbox, pad_box
+import tl_schema
+
+STATE_DICT = {"R": "red", "RY": "red-yellow", "Y" : "yellow", "G": "green", "O": "off", "U": "unknown"}
+COLOR_DICT = {"R": "salmon", "RY": "orange", "Y": "yellow", "G": "lightgreen", "O": "grey", "U": "lightgrey"}
+TYPE_DICT = {"Car": "car", "Ped": "pedestrian", "Bike": "bicycle", "Train": "train", "Bus": "bus", "CW": "car_warning", "Unk": "unknown"}
+Q_COLOR_DICT = {"red": Qt.red, "red-yellow": Qt.magenta, "yellow": Qt.yellow, "green": Qt.green, "off": Qt.black, "unknown": Qt.gray}
+
+CROP_SIZE = (100, 140)
+
+OVERLAY_PEN = 5
+OVERLAY_MARGIN = 4
+
+GEO_SIZE = (500, 500)
+GEO_MARGIN = 20
+GEO_HEADING = 30
+
+def to_qpolygon(obj):
+    qpoints = [QPoint(p[0], p[1]) for p in obj]
+    return QPolygon(qpoints)
+
+def buffer(poly, buffer):
+    # the polygon grown by buffer with round corners. Done with Qt instead of shapely, whose import
+    # would delay the first image
+    path = QPainterPath()
+    path.addPolygon(QPolygonF([QPointF(x, y) for x, y in poly]))
+    path.closeSubpath()
+    stroker = QPainterPathStroker()
+    stroker.setWidth(2 * buffer)
+    stroker.setJoinStyle(Qt.RoundJoin)
+    stroker.setCapStyle(Qt.RoundCap)
+    dilated = stroker.createStroke(path).united(path).simplified()
+    return [(p.x(), p.y()) for p in dilated.toFillPolygon()]
+
+def get_color(attrs, alpha=180):
+    type_lookup = {"car": Qt.cyan, "pedestrian": Qt.green, "bicycle": Qt.yellow, "train": Qt.white, "bus": Qt.white, "unknown": Qt.gray, "car_warning": Qt.cyan}
+    color = type_lookup[attrs["type"]]
+    if attrs["relevant"] == "yes":
+        color = Qt.magenta
+    color = QColor(color)
+    if attrs["visible"] == "no":
+        color = color.darker()
+    color.setAlpha(alpha)
+    return color
+
+def get_color_depth(tl, alpha=180):
+    idx = tl["attributes"]["depth"]
+    colors = [Qt.white, Qt.cyan, Qt.green, Qt.red, Qt.yellow]
+    color = QColor(colors[idx])
+    color.setAlpha(alpha)
+    return color
+
+def make_light_shape(tl):
+    # everything needed to draw a light that does not depend on its attributes, computed once per load
+    poly = to_qpolygon(buffer(tl["polygon"], 5))
+    box = pad_box(to_bbox(tl["polygon"]), 10, IMG_SZ)
+    x = int((box[0][0] + box[1][0]) / 2)
+    if box[0][1] > (IMG_SZ[1] / 2):
+        y = box[0][1] - 20
+    else:
+        y = box[1][1] + 10
+    #rect = QRect(x, y, 150, 25)
+    rect = QRect(int(x), int(y), 50, 25)
+    m = OVERLAY_PEN + OVERLAY_MARGIN
+    bounds = poly.boundingRect().adjusted(-m, -m, m, m).united(rect.adjusted(-m, -m, m, m))
+    return {"poly": poly, "rect": rect, "bounds": bounds}
+
+def set_exclusive(buttons, value):
+    # checks the button of value, or none at all if value has no button
+    if value in buttons:
+        buttons[value].setChecked(True)
+        return
+    for b in buttons.values():
+        b.setAutoExclusive(False)
+        b.setChecked(False)
+        b.setAutoExclusive(True)
+
+def to_truth_vec(names, keys):
+    return [True if n in keys else False for n in names]
+
+def get_centroid(poly):
+    # centroid of the polygon area (shoelace formula)
+    x, y = np.asarray(poly, dtype=np.float64).T
+    cross = x * np.roll(y, -1) - np.roll(x, -1) * y
+    area = cross.sum() / 2
+    return (((x + np.roll(x, -1)) * cross).sum() / (6 * area), ((y + np.roll(y, -1)) * cross).sum() / (6 * area))
+
+class GeoWidget(QWidget):
+    # gps track of the current city with the position and heading of the current image, works offline
+    track_ready = Signal(str)
+
+    def __init__(self, cache):
+        super().__init__()
+        self._cache = cache
+        self._city = None
+        self._name = None
+        self._track = None
+        self._error = None
+        self._xy = None
+        self._layer = None
+        self.setFixedSize(*GEO_SIZE)
+        self.track_ready.connect(self._on_track_ready)
+
+    def show_position(self, city, name):
+        self._name = name
+        if city != self._city:
+            self._city = city
+            self._track = None
+            self._error = None
+            self._layer = None
+            self._watch(city)
+        self.update()
+
+    def _watch(self, city):
+        self._cache.request(city).add_done_callback(lambda f, city=city: self.track_ready.emit(city))
+
+    def gnss(self):
+        return self._track.get(self._name) if self._track is not None else None
+
+    def _on_track_ready(self, city):
+        if city != self._city:
+            return
+        future = self._cache.request(city)
+        if not future.done():
+            # the entry was evicted or replaced since, wait for the new future
+            self._watch(city)
+            return
+        try:
+            self._track = future.result()
+        except Exception as e:
+            self._error = str(e)
+        self._layer = None
+        self.update()
+
+    def _project(self):
+        # equirectangular, good enough for the extent of a city
+        lat, lon = self._track.gnss[:, 0], self._track.gnss[:, 1]
+        x = lon * math.cos(math.radians(lat.mean()))
+        y = lat
+        span = max(np.ptp(x), np.ptp(y), 1e-9)
+        scale = (min(self.width(), self.height()) - 2 * GEO_MARGIN) / span
+        px = (self.width() - np.ptp(x) * scale) / 2 + (x - x.min()) * scale
+        py = (self.height() + np.ptp(y) * scale) / 2 - (y - y.min()) * scale
+        return np.stack([px, py], axis=1)
+
+    def _render_track(self):
+        # the track only changes with the city, the position is drawn on top in paintEvent
+        layer = QPixmap(self.size())
+        layer.fill(Qt.white)
+        self._xy = self._project()
+        qp = QPainter(layer)
+        qp.setPen(QPen(Qt.darkGray, 3))
+        qp.drawPoints(QPolygon.fromList([QPoint(int(x), int(y)) for x, y in self._xy]))
+        qp.end()
+        return layer
+
+    def resizeEvent(self, event):
+        self._layer = None
+        super().resizeEvent(event)
+
+    def paintEvent(self, event):
+        qp = QPainter(self)
+        if self._track is None or not len(self._track):
+            qp.fillRect(self.rect(), Qt.white)
+            text = "Loading GPS track" if self._track is None and self._error is None else "No GPS data"
+            qp.drawText(self.rect(), Qt.AlignCenter, text if self._error is None else "Could not load GPS track: " + self._error)
+            qp.end()
+            return
+        if self._layer is None:
+            self._layer = self._render_track()
+        qp.drawPixmap(0, 0, self._layer)
+        gnss = self.gnss()
+        if gnss is not None:
+            x, y = self._xy[self._track.row(self._name)]
+            lat, lon, heading = gnss
+            # heading is in degrees clockwise from north
+            qp.setPen(QPen(Qt.red, 3))
+            qp.drawLine(int(x), int(y), int(x + GEO_HEADING * math.sin(math.radians(heading))), int(y - GEO_HEADING * math.cos(math.radians(heading))))
+            qp.setBrush(QBrush(Qt.red))
+            qp.drawEllipse(QPoint(int(x), int(y)), 6, 6)
+            qp.setPen(Qt.black)
+            qp.drawText(GEO_MARGIN // 2, self.height() - GEO_MARGIN // 2, "{:.6f}, {:.6f}, {:.0f}\u00b0".format(lat, lon, heading))
+        qp.end()
+
+class OverlayWidget(QWidget):
+    # transparent layer on top of the image label, the lights are drawn into its own pixmap
+    # so the image itself is never copied or repainted for an overlay change
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.setGeometry(parent.rect())
+        self.layer = QPixmap(QSize(*IMG_SZ))
+        self.layer.fill(Qt.transparent)
+
+    def to_widget(self, rect):
+        sx, sy = self.width() / self.layer.width(), self.height() / self.layer.height()
+        return QRect(int(rect.x() * sx), int(rect.y() * sy), int(rect.width() * sx) + 2, int(rect.height() * sy) + 2)
+
+    def paintEvent(self, event):
+        qp = QPainter(self)
+        qp.drawPixmap(self.rect(), self.layer)
+        qp.end()
+
+class EventFilter(QObject):
+    def __init__(self, main_window, tl_idx):
+        super().__init__()
+        self.main_window = main_window
+        self.tl_idx = tl_idx
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Enter:  # Catch the TouchBegin event.
+            self.main_window.set_tl_filter(self.tl_idx)
+            return True
+        elif event.type() == QEvent.Leave:  # Catch the TouchEnd event.
+            self.main_window.remove_tl_filter()
+            return True
+
+        return super().eventFilter(obj, event)
+
+class CropWidget(QWidget):
+    # one entry of the crop panel. Entries are pooled and rebound to the lights of the next image,
+    # the crop pixmap is only cut once the entry scrolls into view.
+    def __init__(self, main_window):
+        super().__init__()
+        self._main = main_window
+        self.tl_idx = None
+        self._crop_rect = None
+        self.crop_loaded = False
+        self.setMaximumHeight(150)
+        self.setMaximumWidth(460)
+        type_button_widget = QWidget()
+        state_button_widget = QWidget()
+        hlayout = QHBoxLayout(self)
+        vlayout = QVBoxLayout()
+        hlayout_top = QHBoxLayout()
+        type_layout = QHBoxLayout(type_button_widget)
+        state_layout = QHBoxLayout(state_button_widget)
+        hlayout_bottom = QHBoxLayout()
+        self.label = QLabel()
+        self.label.setFixedSize(QSize(*CROP_SIZE))
+        self.label.setAlignment(Qt.AlignCenter)
+        self.mouseover_filter = EventFilter(main_window, None)
+        self.label.installEventFilter(self.mouseover_filter)
+        self.name = QLabel()
+        self.name.setStyleSheet("font-weight: bold")
+        self.spinner = QSpinBox()
+        self.spinner.setRange(0, len(tl_schema.values("depth")) - 1)
+        self.spinner.valueChanged[int].connect(self._on_depth)
+        self.spinner.setFixedWidth(50)
+        hlayout_top.addWidget(self.name)
+        hlayout.addWidget(self.label)
+        hlayout.addLayout(vlayout)
+        vlayout.addLayout(hlayout_top)
+        vlayout.addWidget(type_button_widget)
+        vlayout.addWidget(state_button_widget)
+        vlayout.addLayout(hlayout_bottom)
+        hlayout_bottom.addWidget(self.spinner)
+        self.del_button = QPushButton("Delete")
+        self.del_button.clicked.connect(self._on_delete)
+        hlayout_top.addWidget(self.del_button)
+        self.visible_button = QCheckBox("Visible")
+        self.visible_button.toggled[bool].connect(self._on_visible)
+        hlayout_top.addWidget(self.visible_button)
+        self.relevant_box = QCheckBox("Relev")
+        self.relevant_box.toggled[bool].connect(self._on_relevant)
+        hlayout_top.addWidget(self.relevant_box)
+        self.lane_relevant_box = QCheckBox("Lane Rel")
+        self.lane_relevant_box.toggled[bool].connect(self._on_lane_relevant)
+        hlayout_top.addWidget(self.lane_relevant_box)
+        self.buttons_state = {}
+        for state, s_name in STATE_DICT.items():
+            state_button = QRadioButton(state)
+            state_button.setStyleSheet("background-color: {}".format(COLOR_DICT[state]))
+            state_button.toggled[bool].connect(functools.partial(self._on_state, s_name))
+            self.buttons_state[s_name] = state_button
+            state_layout.addWidget(state_button)
+        self.buttons_type = {}
+        for t_name, t_val in TYPE_DICT.items():
+            type_button = QRadioButton(t_name)
+            type_button.toggled[bool].connect(functools.partial(self._on_type, t_val))
+            self.buttons_type[t_val] = type_button
+            type_layout.addWidget(type_button)
+        self._inputs = [self.spinner, self.visible_button, self.relevant_box, self.lane_relevant_box] + list(self.buttons_state.values()) + list(self.buttons_type.values())
+
+    def bind(self, tl_idx, tl, crop_rect):
+        self.tl_idx = tl_idx
+        self.mouseover_filter.tl_idx = tl_idx
+        self._crop_rect = crop_rect
+        self.crop_loaded = False
+        self.label.clear()
+        self.name.setText(str(tl_idx))
+        attrs = tl["attributes"]
+        # showing the values of a light is not an edit
+        for w in self._inputs:
+            w.blockSignals(True)
+        self.spinner.setValue(attrs["depth"])
+        self.visible_button.setChecked(attrs["visible"] == "yes")
+        self.relevant_box.setChecked(attrs["relevant"] == "yes")
+        self.lane_relevant_box.setChecked(attrs["lane_relevant"] == "yes")
+        set_exclusive(self.buttons_state, attrs["state"])
+        set_exclusive(self.buttons_type, attrs["type"])
+        for w in self._inputs:
+            w.blockSignals(False)
+
+    def unbind(self):
+        self.tl_idx = None
+        self.mouseover_filter.tl_idx = None
+        self.label.clear()
+        self.crop_loaded = False
+
+    def load_crop(self, pixmap):
+        if not self.crop_loaded and self._crop_rect is not None:
+            self.label.setPixmap(pixmap.copy(self._crop_rect).scaled(QSize(*CROP_SIZE), Qt.KeepAspectRatio))
+            self.crop_loaded = True
+
+    def _on_type(self, value, checked):
+        # radio buttons also report being unchecked, only the newly checked one is an edit
+        if checked and self.tl_idx is not None:
+            self._main.on_type(self.tl_idx, value, checked)
+
+    def _on_state(self, value, checked):
+        if checked and self.tl_idx is not None:
+            self._main.on_state(self.tl_idx, value, checked)
+
+    def _on_visible(self, checked):
+        if self.tl_idx is not None:
+            self._main.on_visible(self.tl_idx, checked)
+
+    def _on_relevant(self, checked):
+        if self.tl_idx is not None:
+            self._main.on_relevant(self.tl_idx, checked)
+
+    def _on_lane_relevant(self, checked):
+        if self.tl_idx is not None:
+            self._main.on_lane_relevant(self.tl_idx, checked)
+
+    def _on_depth(self, depth):
+        if self.tl_idx is not None:
+            self._main.on_depth(self.tl_idx, depth)
+
+    def _on_delete(self):
+        if self.tl_idx is not None:
+            self._main.on_delete(self.tl_idx)
@@ -3,7 +3,20 @@
 import json
 import argparse
 import os
-from progressbar import progressbar
+import sys
+import hashlib
+import shutil
+import tempfile
+import batch_runner
+import changeset_io
+
+APPLIED = "applied"
+UNCHANGED = "unchanged"
+SKIPPED = "skipped"
+FAILED = "failed"
+RESULTS = [APPLIED, UNCHANGED, SKIPPED, FAILED]
+# one line per file the changeset was applied to, lets reruns recognise entries without creates
+STATE_FILE = ".applied_changes.jsonl"
 
 def delete_from_list(list_object, indices):
     indices = sorted(indices, reverse=True)
@@ -21,13 +34,119 @@ def apply_change_to_objects(objects: list, changes: dict):
     for idx, change in changes["create"].items():
         objects.insert(int(idx), change)
 
-def apply_change_to_file(fn, change, dry_run):
-    with open(fn, "r") as f:
-        root = json.load(f)
-        apply_change_to_objects(root["objects"], change)
+def is_applied(objects: list, changes: dict):
+    # created lights already sitting at their target index mean an earlier run got here first
+    if not changes["create"]:
+        return False
+    return all(int(idx) < len(objects) and objects[int(idx)] == obj for idx, obj in changes["create"].items())
+
+def digest(data: bytes):
+    return hashlib.sha256(data).digest()
+
+def change_digest(change: dict):
+    return digest(json.dumps(change, sort_keys=True).encode()).hex()
+
+def read_state(basedir):
+    # file -> {"change", "before", "after"} of its last application, a torn last line is ignored
+    state = {}
+    path = os.path.join(basedir, STATE_FILE)
+    if not os.path.exists(path):
+        return state
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            state[rec["file"]] = rec
+    return state
+
+class StateWriter():
+    def __init__(self, basedir):
+        self._f = open(os.path.join(basedir, STATE_FILE), "a")
+
+    def __call__(self, fn, res):
+        record = res[3]
+        if record is not None:
+            self._f.write(json.dumps(dict(record, file=fn)) + "\n")
+            self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+def write_atomic(fn, data: bytes):
+    # write next to the target and rename, so a crash never leaves a truncated label file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fn) or ".", prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        shutil.copymode(fn, tmp)
+        os.replace(tmp, fn)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+def apply_change_to_file(fn, change, dry_run, record=None):
+    # returns the state record of the application, or None if the file was left as it is.
+    # Deletes and updates are not idempotent, so a file recorded as patched by this entry is only
+    # patched again if it still has its original content
+    with open(fn, "rb") as f:
+        orig = f.read()
+    before = digest(orig).hex()
+    if record is not None and record["change"] == change_digest(change):
+        if before == record["after"]:
+            return None
+        if before != record["before"]:
+            raise ValueError("modified since the changeset was applied")
+    root = json.loads(orig)
+    if is_applied(root["objects"], change):
+        return None
+    apply_change_to_objects(root["objects"], change)
+    data = json.dumps(root, indent=4, sort_keys=True).encode()
+    if digest(data) == digest(orig):
+        return None
     if not dry_run:
-        with open(fn, "w") as f:
-            json.dump(root, f,  indent=4, sort_keys=True)
+        write_atomic(fn, data)
+    return {"change": change_digest(change), "before": before, "after": digest(data).hex()}
+
+def process_entry(basedir, fn, change, dry_run, record=None):
+    path = os.path.join(basedir, fn)
+    if not os.path.exists(path):
+        return fn, SKIPPED, "file not found", None
+    try:
+        applied = apply_change_to_file(path, change, dry_run, record)
+    except (OSError, ValueError, KeyError, IndexError, TypeError) as e:
+        return fn, FAILED, "{}: {}".format(type(e).__name__, e), None
+    return fn, APPLIED if applied else UNCHANGED, None, None if dry_run else applied
+
+def _process_entry(task):
+    return process_entry(*task)
+
+def apply_changeset(basedir, changes, dry_run=False, jobs=1, journal=None, signature=""):
+    # every file is handled by exactly one worker, so a file is either fully patched or untouched
+    state = read_state(basedir)
+    tasks = [(basedir, fn, change, dry_run, state.get(fn)) for fn, change in sorted(changes.items())]
+    writer = None if dry_run else StateWriter(basedir)
+    try:
+        results = batch_runner.run_batch(_process_entry, tasks, [t[1] for t in tasks], journal, signature, jobs,
+                                         succeeded=lambda r: r[1] != FAILED, on_result=writer)
+    finally:
+        if writer:
+            writer.close()
+    return sorted(r[:3] for r in results)
+
+def print_summary(results, out=sys.stdout):
+    counts = {r: 0 for r in RESULTS}
+    for _, res, _ in results:
+        counts[res] += 1
+    print(", ".join("{} {}".format(counts[r], r) for r in RESULTS), file=out)
+    for fn, res, msg in results:
+        if res in (SKIPPED, FAILED):
+            print("{} {}: {}".format(res, fn, msg), file=out)
+    return counts
 
 
 if __name__ == "__main__":
@@ -35,9 +154,15 @@ if __name__ == "__main__":
     parser.add_argument("basedir")
     parser.add_argument("changeset")
     parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--journal", type=str, help="checkpoint file, an interrupted run resumes from it")
     args = parser.parse_args()
 
-    with open(args.changeset) as cfile:
-        changes = json.load(cfile)
-        for fn, change in progressbar(changes.items()):
-            apply_change_to_file(os.path.join(args.basedir, fn), change, args.dry_run)
\ No newline at end of file
+    changes = changeset_io.load(args.changeset)
+    signature = "{} {}".format(os.path.abspath(args.basedir), os.path.abspath(args.changeset))
+    try:
+        results = apply_changeset(args.basedir, changes, args.dry_run, args.jobs, None if args.dry_run else args.journal, signature)
+    except KeyboardInterrupt:
+        sys.exit("Interrupted")
+    counts = print_summary(results)
+    sys.exit(1 if counts[FAILED] else 0)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import multiprocessing
+import progressbar
+
+SIGNATURE_PREFIX = "# "
+
+def make_progressbar(total, unit="files"):
+    widgets = [progressbar.Percentage(), " (", progressbar.SimpleProgress(), ") ", progressbar.Bar(), " ",
+               progressbar.AdaptiveTransferSpeed(unit=unit), " ", progressbar.AdaptiveETA()]
+    return progressbar.ProgressBar(max_value=total, widgets=widgets)
+
+class Checkpoint():
+    # append-only journal with one finished key per line, survives crashes and ctrl-c
+    def __init__(self, path, signature=""):
+        self._path = path
+        self._done = set()
+        self._f = None
+        if path is None:
+            return
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                lines = f.read().split("\n")
+            if lines[0] != SIGNATURE_PREFIX + signature:
+                raise RuntimeError("Journal {} belongs to a different run ({}), remove it to start over".format(path, lines[0][len(SIGNATURE_PREFIX):]))
+            # the last line is only complete if it ends with a newline
+            self._done = set(l for l in lines[1:-1] if l)
+            self._f = open(path, "a")
+        else:
+            self._f = open(path, "w")
+            self._f.write(SIGNATURE_PREFIX + signature + "\n")
+            self._f.flush()
+
+    def is_done(self, key):
+        return key in self._done
+
+    def mark_done(self, key):
+        self._done.add(key)
+        if self._f:
+            self._f.write(key + "\n")
+            self._f.flush()
+
+    def __len__(self):
+        return len(self._done)
+
+    def close(self, finished=False):
+        if self._f:
+            self._f.close()
+            self._f = None
+            if finished:
+                os.unlink(self._path)
+
+def run_batch(func, tasks, keys, journal=None, signature="", jobs=1, unit="files", succeeded=None, on_result=None,
+              initializer=None, initargs=()):
+    # func runs on every task not yet in the journal, keys name the tasks in the journal,
+    # succeeded(result) decides whether a task counts as done (default: always),
+    # on_result(key, result) runs in the calling process before the key is journalled.
+    # initializer(*initargs) runs once per worker, data shared by all tasks is sent once instead of per task
+    checkpoint = Checkpoint(journal, signature)
+    todo = [(k, t) for k, t in zip(keys, tasks) if not checkpoint.is_done(k)]
+    if len(checkpoint):
+        print("Resuming, {} of {} {} already done".format(len(tasks) - len(todo), len(tasks), unit), file=sys.stderr)
+    results = []
+    bar = make_progressbar(len(todo), unit)
+    pool = multiprocessing.Pool(jobs, initializer, initargs) if jobs > 1 and len(todo) > 1 else None
+    if not pool and initializer:
+        initializer(*initargs)
+    try:
+        if pool:
+            it = pool.imap_unordered(_run_keyed, [(func, k, t) for k, t in todo], chunksize=max(1, len(todo) // (jobs * 32)))
+        else:
+            it = (_run_keyed((func, k, t)) for k, t in todo)
+        for i, (key, res) in enumerate(it):
+            if on_result:
+                on_result(key, res)
+            if succeeded is None or succeeded(res):
+                checkpoint.mark_done(key)
+            results.append(res)
+            bar.update(i + 1)
+        bar.finish()
+    except KeyboardInterrupt:
+        if pool:
+            pool.terminate()
+        checkpoint.close()
+        if journal:
+            print("\nInterrupted, rerun with the same journal to resume", file=sys.stderr)
+        raise
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    finished = all(succeeded(r) for r in results) if succeeded else True
+    checkpoint.close(finished)
+    return results
+
+def _run_keyed(item):
+    func, key, task = item
+    return key, func(task)
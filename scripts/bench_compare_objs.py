@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import glob
+import argparse
+import os
+import random
+import itertools
+import timeit
+import contextlib
+from create_changeset import read_json, get_idxs, compare_obj, compare_objs, FILE_PATTERN
+
+def compare_objs_pairwise(orig, new):
+    orig_idxs, new_idxs = get_idxs(orig), get_idxs(new)
+    new_to_orig = {n: o for n, o in itertools.product(new_idxs, orig_idxs) if compare_obj(orig[o], new[n])}
+    to_create = [n for n in new_idxs if n not in new_to_orig.keys()]
+    to_delete = [o for o in orig_idxs if o not in new_to_orig.values()]
+    return new_to_orig, to_delete, to_create
+
+def pairs_from_dirs(orig_dir, new_dir, city):
+    pairs = []
+    for new_f in sorted(glob.glob(os.path.join(new_dir, FILE_PATTERN))):
+        if city and city not in new_f:
+            continue
+        old_f = os.path.join(orig_dir, os.path.relpath(new_f, new_dir))
+        pairs.append((read_json(old_f)["objects"], read_json(new_f)["objects"]))
+    return pairs
+
+def pairs_from_changeset(changeset, group):
+    # the shipped changeset only holds the created lights, use their polygons to fake both sides of a diff
+    rnd = random.Random(0)
+    pairs = []
+    changes = [c for _, c in sorted(read_json(changeset).items()) if c["create"]]
+    for i in range(0, len(changes), group):
+        new = [o for c in changes[i:i + group] for o in c["create"].values()]
+        orig = [dict(o, attributes={}) for o in new if rnd.random() > 0.2]
+        rnd.shuffle(orig)
+        pairs.append((orig, new))
+    return pairs
+
+def run(func, pairs):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull):
+        return [func(orig, new) for orig, new in pairs]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orig-dir")
+    parser.add_argument("--new-dir")
+    parser.add_argument("--city", default="dusseldorf")
+    parser.add_argument("--changeset", default=os.path.join(os.path.dirname(__file__), os.pardir, "changes_dusseldorf.json"))
+    parser.add_argument("--group", type=int, default=1, help="merge the lights of this many changeset files into one image")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.orig_dir and args.new_dir:
+        pairs = pairs_from_dirs(args.orig_dir, args.new_dir, args.city)
+    else:
+        pairs = pairs_from_changeset(args.changeset, args.group)
+    if not pairs:
+        raise RuntimeError("No files to compare found")
+    if run(compare_objs_pairwise, pairs) != run(compare_objs, pairs):
+        raise RuntimeError("Matchers disagree")
+    n_objs = sum(len(new) for _, new in pairs)
+    print("{} files, {} objects".format(len(pairs), n_objs))
+    for name, func in [("pairwise", compare_objs_pairwise), ("hashed", compare_objs)]:
+        t = min(timeit.repeat(lambda: run(func, pairs), number=1, repeat=args.repeat))
+        print("{:>10}: {:8.2f} ms".format(name, t * 1000))
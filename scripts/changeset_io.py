@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import json
+import struct
+import zlib
+import os
+
+MAGIC = b"TLCS"
+VERSION = 1
+BIN_SUFFIX = ".tlcs"
+HEADER = struct.Struct("<4sH")
+TRAILER = struct.Struct("<Q4s")
+U32 = struct.Struct("<I")
+POLY_HEADER = struct.Struct("<IB")
+INT_MIN, INT_MAX = -2 ** 31, 2 ** 31 - 1
+
+# polygon encodings: all coordinates int, all float, or float with a bitmap marking the ints
+POLY_INT = 0
+POLY_FLOAT = 1
+POLY_MIXED = 2
+
+def encode_polygon(poly):
+    values = [v for p in poly for v in p]
+    ints = [isinstance(v, int) and not isinstance(v, bool) for v in values]
+    if all(ints) and all(INT_MIN <= v <= INT_MAX for v in values):
+        return POLY_HEADER.pack(len(poly), POLY_INT) + struct.pack("<{}i".format(len(values)), *values)
+    data = struct.pack("<{}d".format(len(values)), *values)
+    if not any(ints):
+        return POLY_HEADER.pack(len(poly), POLY_FLOAT) + data
+    bitmap = bytearray((len(values) + 7) // 8)
+    for i, is_int in enumerate(ints):
+        if is_int:
+            bitmap[i // 8] |= 1 << (i % 8)
+    return POLY_HEADER.pack(len(poly), POLY_MIXED) + data + bytes(bitmap)
+
+def decode_polygon(buf, offset):
+    n, kind = POLY_HEADER.unpack_from(buf, offset)
+    offset += POLY_HEADER.size
+    count = 2 * n
+    if kind == POLY_INT:
+        values = list(struct.unpack_from("<{}i".format(count), buf, offset))
+        offset += 4 * count
+    else:
+        values = list(struct.unpack_from("<{}d".format(count), buf, offset))
+        offset += 8 * count
+        if kind == POLY_MIXED:
+            bitmap = buf[offset:offset + (count + 7) // 8]
+            offset += len(bitmap)
+            values = [int(v) if bitmap[i // 8] & (1 << (i % 8)) else v for i, v in enumerate(values)]
+    return [values[i:i + 2] for i in range(0, count, 2)], offset
+
+def encode_change(change):
+    # created objects keep all their fields in the json part, only the polygons are packed
+    meta = dict(change, create={})
+    polys = []
+    for idx, obj in change["create"].items():
+        # the polygon key stays in place with a dummy value to keep the key order
+        meta["create"][idx] = {k: (0 if k == "polygon" else v) for k, v in obj.items()}
+        if "polygon" in obj:
+            polys.append(encode_polygon(obj["polygon"]))
+    # key order is kept as is, so the polygons line up again when decoding and json output round-trips exactly
+    js = json.dumps(meta, separators=(",", ":")).encode()
+    return zlib.compress(U32.pack(len(js)) + js + b"".join(polys))
+
+def decode_change(blob):
+    buf = zlib.decompress(blob)
+    n = U32.unpack_from(buf, 0)[0]
+    offset = U32.size + n
+    change = json.loads(buf[U32.size:offset])
+    for obj in change["create"].values():
+        if "polygon" in obj:
+            obj["polygon"], offset = decode_polygon(buf, offset)
+    return change
+
+def is_binary(fn):
+    with open(fn, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+class ChangesetWriter():
+    def __init__(self, fn):
+        self._f = open(fn, "wb")
+        self._f.write(HEADER.pack(MAGIC, VERSION))
+        self._index = {}
+
+    def write(self, fn, change):
+        if fn in self._index:
+            raise ValueError("Duplicate entry " + fn)
+        blob = encode_change(change)
+        self._index[fn] = [self._f.tell(), len(blob)]
+        self._f.write(blob)
+
+    def close(self):
+        if self._f.closed:
+            return
+        index_offset = self._f.tell()
+        self._f.write(zlib.compress(json.dumps(self._index, separators=(",", ":")).encode()))
+        self._f.write(TRAILER.pack(index_offset, MAGIC))
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ChangesetReader():
+    def __init__(self, fn):
+        self._f = open(fn, "rb")
+        magic, version = HEADER.unpack(self._f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("{} is not a binary changeset".format(fn))
+        if version != VERSION:
+            raise ValueError("Unsupported changeset version {} in {}".format(version, fn))
+        self._f.seek(-TRAILER.size, os.SEEK_END)
+        trailer_offset = self._f.tell()
+        index_offset, magic = TRAILER.unpack(self._f.read(TRAILER.size))
+        if magic != MAGIC:
+            raise ValueError("{} is truncated".format(fn))
+        self._f.seek(index_offset)
+        self._index = json.loads(zlib.decompress(self._f.read(trailer_offset - index_offset)))
+
+    def _read(self, fn):
+        offset, length = self._index[fn]
+        self._f.seek(offset)
+        return decode_change(self._f.read(length))
+
+    def __getitem__(self, fn):
+        return self._read(fn)
+
+    def __contains__(self, fn):
+        return fn in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, fn, default=None):
+        return self._read(fn) if fn in self._index else default
+
+    def keys(self):
+        return sorted(self._index.keys(), key=lambda k: self._index[k][0])
+
+    def items(self):
+        for fn in self.keys():
+            yield fn, self._read(fn)
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def load(fn):
+    if is_binary(fn):
+        return ChangesetReader(fn)
+    with open(fn, "r") as f:
+        return json.load(f)
+
+def dump(changes, fn, sort_keys=True):
+    if fn.endswith(BIN_SUFFIX):
+        with ChangesetWriter(fn) as w:
+            for key in sorted(changes.keys()):
+                w.write(key, changes[key])
+    else:
+        if not isinstance(changes, dict):
+            changes = dict(changes.items())
+        with open(fn, "w") as f:
+            json.dump(changes, f, indent=4, sort_keys=sort_keys)
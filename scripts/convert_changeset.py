@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import changeset_io
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a changeset between json and the binary format, the direction is chosen by the output suffix")
+    parser.add_argument("infile")
+    parser.add_argument("outfile", help="binary if it ends with " + changeset_io.BIN_SUFFIX + ", json otherwise")
+    args = parser.parse_args()
+
+    changes = changeset_io.load(args.infile)
+    # keep the key order of the input, so json -> binary -> json reproduces the original file
+    changeset_io.dump(changes, args.outfile, sort_keys=False)
+    print("Wrote {} entries to {} ({} bytes)".format(len(changes), args.outfile, os.path.getsize(args.outfile)))
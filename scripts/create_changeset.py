@@ -8,7 +8,11 @@ from progressbar import progressbar
 import sys
 import os
 import csv
-import itertools
+import collections
+import hashlib
+import multiprocessing
+import changeset_io
+import tl_schema
 
 class Dump(Enum):
     PATH = "relative_file_path"
@@ -18,44 +22,16 @@ class Dump(Enum):
     TYPE = "type"
     VISIBLE = "visible"
 
-SCHEMA = {"relevant": ["yes", "no"], "state": ["red", "yellow", "green", "off", "unknown"], "type": ["car", "pedestrian", "bicycle", "unknown", "train"], "visible": ["yes", "no"]}
-KEYS = sorted(SCHEMA.keys())
-LABEL = "traffic light"
+LABEL = tl_schema.LABEL
 FILE_PATTERN = "gtFine/*/*/*gtFine_polygons.json"
 
 def get_by_label(labels, label):
     return [obj for obj in labels["objects"] if obj["label"] == label and not ("deleted" in obj.keys() and obj["deleted"])]
 
-def check_keys(comp):
-    for c in comp:
-        if c not in KEYS:
-            return False
-    for k in KEYS:
-        if k not in comp:
-            return False
-    return True
-
-def check_values(key, choices, actual):
-    if not actual:
-        return False
-    if actual not in choices:
-        return False
-    return True
-
-def check_attr_map(attrs):
-    comp = sorted(attrs.keys())
-    if not check_keys(comp):
-        return False
-    for k in KEYS:
-        if k in comp:
-            if not check_values(k, SCHEMA[k], attrs[k]):
-                return False
-    return True
-
 def check_attributes(obj):
     if not "attributes" in obj.keys():
         return False
-    return check_attr_map(obj["attributes"])
+    return tl_schema.is_valid(obj["attributes"])
 
 def check_has_id(fn):
     with open(fn, "r") as f:
@@ -87,11 +63,36 @@ def get_idxs(obj,label="traffic light"):
 def compare_obj(orig, new):
     return orig["polygon"] == new["polygon"]
 
-def compare_objs(orig, new):
+def polygon_key(obj):
+    # cheap bucket key, candidates within a bucket are still compared point by point
+    poly = obj["polygon"]
+    if not poly:
+        return 0,
+    return len(poly), tuple(poly[0]), tuple(poly[-1])
+
+def index_polygons(objs, idxs):
+    index = {}
+    for idx in idxs:
+        index.setdefault(polygon_key(objs[idx]), []).append(idx)
+    return index
+
+def compare_objs(orig, new, fn=""):
     orig_idxs, new_idxs = get_idxs(orig), get_idxs(new)
-    new_to_orig = {n: o for n, o in itertools.product(new_idxs, orig_idxs) if compare_obj(orig[o], new[n])}
-    to_create = [n for n in new_idxs if n not in new_to_orig.keys()]
-    to_delete = [o for o in orig_idxs if o not in new_to_orig.values()]
+    orig_index = index_polygons(orig, orig_idxs)
+    new_to_orig = {}
+    for n in new_idxs:
+        matches = [o for o in orig_index.get(polygon_key(new[n]), []) if compare_obj(orig[o], new[n])]
+        if not matches:
+            continue
+        if len(matches) > 1:
+            print("Warning: {} polygon of new object {} matches original objects {}, using {}".format(fn, n, matches, matches[-1]), file=sys.stderr)
+        new_to_orig[n] = matches[-1]
+    matched = collections.Counter(new_to_orig.values())
+    for o, cnt in matched.items():
+        if cnt > 1:
+            print("Warning: {} original object {} matched by {} new objects".format(fn, o, cnt), file=sys.stderr)
+    to_create = [n for n in new_idxs if n not in new_to_orig]
+    to_delete = [o for o in orig_idxs if o not in matched]
     return new_to_orig, to_delete, to_create
 
 def make_changeset(new, changes):
@@ -104,27 +105,110 @@ def make_changeset(new, changes):
 def changes_empty(changeset):
     return len(changeset["update"]) == 0 and len(changeset["delete"]) == 0 and len(changeset["create"]) == 0
 
+def get_city(fn):
+    return fn.split("/")[2]
+
+def file_stat(fn):
+    st = os.stat(fn)
+    return st.st_size, st.st_mtime_ns
+
+def file_hash(fn):
+    with open(fn, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def read_manifest(fn):
+    if not os.path.exists(fn):
+        return {"orig": {}, "new": {}}
+    return read_json(fn)
+
+def stat_unchanged(manifest, tree, fn, stat):
+    entry = manifest[tree].get(fn)
+    return entry is not None and tuple(entry[:2]) == stat
+
+def diff_file(orig_dir, new_dir, fn, known):
+    # known holds the manifest hashes, a file is only parsed if its content really changed
+    old_f, new_f = os.path.join(orig_dir, fn), os.path.join(new_dir, fn)
+    entries = {}
+    for tree, path in (("orig", old_f), ("new", new_f)):
+        entries[tree] = list(file_stat(path)) + [file_hash(path)]
+    if known is not None and known == (entries["orig"][2], entries["new"][2]):
+        return fn, entries, False, None
+    orig_objs = read_json(old_f)["objects"]
+    new_objs = read_json(new_f)["objects"]
+    return fn, entries, True, make_changeset(new_objs, compare_objs(orig_objs, new_objs, fn))
+
+def _diff_file(task):
+    return diff_file(*task)
+
+def find_files(new_dir, cities):
+    files = sorted(os.path.relpath(f, new_dir) for f in glob.glob(os.path.join(new_dir, FILE_PATTERN)))
+    if cities:
+        files = [f for f in files if get_city(f) in cities]
+    return files
+
+def create_changeset(orig_dir, new_dir, files, manifest, changes, jobs=1):
+    tasks = []
+    for fn in files:
+        orig_stat = file_stat(os.path.join(orig_dir, fn))
+        new_stat = file_stat(os.path.join(new_dir, fn))
+        if stat_unchanged(manifest, "orig", fn, orig_stat) and stat_unchanged(manifest, "new", fn, new_stat):
+            continue
+        known = None
+        if fn in manifest["orig"] and fn in manifest["new"]:
+            known = manifest["orig"][fn][2], manifest["new"][fn][2]
+        tasks.append((orig_dir, new_dir, fn, known))
+    if jobs > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            results = list(progressbar(pool.imap_unordered(_diff_file, tasks, chunksize=8), max_value=len(tasks)))
+    else:
+        results = [_diff_file(t) for t in progressbar(tasks)]
+    rediffed = 0
+    for fn, entries, diffed, changeset in results:
+        manifest["orig"][fn] = entries["orig"]
+        manifest["new"][fn] = entries["new"]
+        if not diffed:
+            continue
+        rediffed += 1
+        if changes_empty(changeset):
+            changes.pop(fn, None)
+        else:
+            changes[fn] = changeset
+    return rediffed
+
+def drop_missing(files, manifest, changes, cities):
+    # forget files that vanished from the new tree, but leave cities outside the filter alone
+    present = set(files)
+    for tree in ("orig", "new"):
+        for fn in list(manifest[tree].keys()):
+            if fn not in present and (not cities or get_city(fn) in cities):
+                del manifest[tree][fn]
+    for fn in list(changes.keys()):
+        if fn not in present and (not cities or get_city(fn) in cities):
+            del changes[fn]
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--orig-dir", required=True)
     parser.add_argument("--new-dir", required=True)
-    parser.add_argument("--outfile", "-o", type=str, required=True)
+    parser.add_argument("--outfile", "-o", type=str, required=True, help="written in the binary format if it ends with " + changeset_io.BIN_SUFFIX)
+    parser.add_argument("--city", action="append", help="only diff this city, can be given multiple times")
+    parser.add_argument("--manifest", type=str, help="defaults to <outfile>.manifest")
+    parser.add_argument("--full", action="store_true", help="ignore the manifest and re-diff every file")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="number of worker processes")
     args = parser.parse_args()
 
-    old_wd = os.getcwd()
-    os.chdir(args.new_dir)
-    files = glob.glob(FILE_PATTERN)
+    manifest_file = args.manifest if args.manifest else args.outfile + ".manifest"
+    files = find_files(args.new_dir, args.city)
     if not files:
-        raise RuntimeError("No files in " + args.basedir + " found")
-    changes = {}
-    for new_f in progressbar(files):
-        old_f = os.path.join(args.orig_dir, new_f)
-        orig_objs = read_json(old_f)["objects"]
-        new_objs = read_json(new_f)["objects"]
-        changeset = make_changeset(new_objs, compare_objs(orig_objs, new_objs))
-        if not changes_empty(changeset) and "dusseldorf" in new_f:
-            changes[new_f] = changeset
-    with open(args.outfile, 'w') as of:
-        json.dump(changes, of, indent=4, sort_keys=True)
-    os.chdir(old_wd)
-    print("Wrote changeset to {}".format(args.outfile))
\ No newline at end of file
+        raise RuntimeError("No files in " + args.new_dir + " found")
+    if args.full or not os.path.exists(args.outfile):
+        manifest, changes = {"orig": {}, "new": {}}, {}
+    else:
+        manifest, changes = read_manifest(manifest_file), dict(changeset_io.load(args.outfile).items())
+    drop_missing(files, manifest, changes, args.city)
+    rediffed = create_changeset(args.orig_dir, args.new_dir, files, manifest, changes, args.jobs)
+    changeset_io.dump(changes, args.outfile)
+    with open(manifest_file, 'w') as mf:
+        json.dump(manifest, mf, sort_keys=True)
+    print("Re-diffed {} of {} files".format(rediffed, len(files)))
+    print("Wrote changeset to {}".format(args.outfile))
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import json
+import argparse
+import os
+import sys
+import shutil
+import tempfile
+from pathlib import Path
+import numpy as np
+
+VERSION = 1
+META_FILE = "meta.json"
+COLUMNS = ["offsets", "obj_idx", "depth"]
+LABEL_ENDING = "_gtFine_polygons.json"
+
+# all_boxes.txt has one light per line: "<label file> <object index> ... <depth>", columns are
+# separated by whitespace, columns between the index and the depth are ignored
+def parse_line(line, prefix=None):
+    # None for comments and empty lines, ValueError for lines that do not have this layout
+    parts = line.split()
+    if not parts or parts[0].startswith("#"):
+        return None
+    if len(parts) < 3:
+        raise ValueError("expected at least 3 columns, got {}".format(len(parts)))
+    return label_stem(parts[0], prefix), int(parts[1]), float(parts[-1])
+
+def label_stem(fn, prefix=None):
+    # "<prefix>/gtFine/train/aachen/aachen_000000_000019_gtFine_polygons.json" -> "train/aachen/aachen_000000_000019"
+    if prefix:
+        fn = os.path.relpath(fn, prefix)
+    parts = fn.split("/")
+    if len(parts) < 3:
+        raise ValueError("{} is not a <split>/<city>/<file> path".format(fn))
+    split, city, name = parts[-3:]
+    return "{}/{}/{}".format(split, city, name.replace(LABEL_ENDING, ""))
+
+def ensure_dir(d):
+    if os.path.exists(d) and not os.path.isdir(d):
+        raise FileExistsError("{} exists and is not a directory".format(d))
+    Path(d).mkdir(parents=True, exist_ok=True)
+
+def replace_dir(tmp, path):
+    # a directory can not be replaced in one step, after a crash between both renames path is missing
+    # and gets rebuilt, it never holds a mix of old and new files
+    if os.path.exists(path) and not os.path.isdir(path):
+        raise FileExistsError("{} exists and is not a directory".format(path))
+    # mkdtemp creates the directory private, give it the permissions of a normal mkdir
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp, 0o777 & ~umask)
+    old = None
+    if os.path.exists(path):
+        old = tempfile.mkdtemp(dir=os.path.dirname(path), prefix="." + os.path.basename(path) + ".old.")
+        os.rename(path, os.path.join(old, "store"))
+    os.rename(tmp, path)
+    if old:
+        shutil.rmtree(old)
+
+def build_store(txt_file, prefix=None):
+    rows = []
+    bad = []
+    with open(txt_file, "r") as f:
+        for i, line in enumerate(f, 1):
+            try:
+                row = parse_line(line, prefix)
+            except ValueError as e:
+                bad.append((i, e))
+                continue
+            if row is not None:
+                rows.append(row)
+    if bad:
+        print("Skipped {} malformed lines of {}, first at line {}: {}".format(len(bad), txt_file, *bad[0]), file=sys.stderr)
+    rows.sort()
+    stems = sorted({r[0] for r in rows})
+    counts = np.bincount(np.searchsorted(stems, [r[0] for r in rows]), minlength=len(stems)) if rows else np.zeros(0, dtype=np.int64)
+    cols = {
+        "offsets": np.zeros(len(stems) + 1, dtype=np.int64),
+        "obj_idx": np.array([r[1] for r in rows], dtype=np.int32),
+        "depth": np.array([r[2] for r in rows], dtype=np.float32),
+    }
+    cols["offsets"][1:] = np.cumsum(counts)
+    meta = {"version": VERSION, "source": os.path.abspath(txt_file), "source_mtime": os.stat(txt_file).st_mtime_ns, "stems": stems}
+    return DepthStore(cols, meta)
+
+class DepthStore():
+    def __init__(self, columns, meta):
+        self._cols = columns
+        self._meta = meta
+        self.stems = meta["stems"]
+        self._rows = {s: i for i, s in enumerate(self.stems)}
+
+    @staticmethod
+    def load(path, mmap=True):
+        meta = read_json(os.path.join(path, META_FILE))
+        if meta["version"] != VERSION:
+            raise ValueError("Depth store {} has version {}, expected {}".format(path, meta["version"], VERSION))
+        cols = {c: np.load(os.path.join(path, c + ".npy"), mmap_mode="r" if mmap else None) for c in COLUMNS}
+        return DepthStore(cols, meta)
+
+    def save(self, path):
+        # written to a temporary directory next to path that replaces it at the end, a crash never
+        # leaves new columns next to an old meta.json
+        path = os.path.abspath(path)
+        ensure_dir(os.path.dirname(path))
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(path), prefix="." + os.path.basename(path) + ".tmp.")
+        try:
+            for name, col in self._cols.items():
+                np.save(os.path.join(tmp, name + ".npy"), col)
+            with open(os.path.join(tmp, META_FILE), "w") as f:
+                json.dump(self._meta, f)
+            replace_dir(tmp, path)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    def __len__(self):
+        return len(self._cols["depth"])
+
+    def __contains__(self, stem):
+        return stem in self._rows
+
+    def is_current(self, txt_file):
+        return os.path.exists(txt_file) and os.stat(txt_file).st_mtime_ns == self._meta["source_mtime"]
+
+    def arrays(self, stem):
+        # object indices and depths of one image, views into the mapped columns
+        if stem not in self._rows:
+            return self._cols["obj_idx"][:0], self._cols["depth"][:0]
+        i = self._rows[stem]
+        sl = slice(int(self._cols["offsets"][i]), int(self._cols["offsets"][i + 1]))
+        return self._cols["obj_idx"][sl], self._cols["depth"][sl]
+
+    def get(self, stem):
+        obj_idx, depth = self.arrays(stem)
+        return dict(zip(obj_idx.tolist(), depth.tolist()))
+
+def read_json(fn):
+    with open(fn, "r") as f:
+        return json.load(f)
+
+def open_store(txt_file, store_dir, prefix=None, rebuild=False):
+    # converts txt_file once, later calls only map the arrays. Returns None without a depth file.
+    if not rebuild and os.path.exists(os.path.join(store_dir, META_FILE)):
+        store = DepthStore.load(store_dir)
+        if store.is_current(txt_file) or not os.path.exists(txt_file):
+            return store
+    if not os.path.exists(txt_file):
+        return None
+    store = build_store(txt_file, prefix)
+    store.save(store_dir)
+    return DepthStore.load(store_dir)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert all_boxes.txt into a memory-mapped depth store")
+    parser.add_argument("txt_file")
+    parser.add_argument("store_dir")
+    parser.add_argument("--prefix", type=str, help="directory the label file paths in txt_file are relative to")
+    args = parser.parse_args()
+
+    store = open_store(args.txt_file, args.store_dir, args.prefix, rebuild=True)
+    print("Stored {} depths of {} images in {}".format(len(store), len(store.stems), args.store_dir))
@@ -11,7 +11,13 @@ import csv
 import itertools
 from PIL import Image
 import cv2
+import numpy as np
 from pathlib import Path
+import multiprocessing
+import queue
+import tl_index
+import image_access
+import batch_runner
 
 class Dump(Enum):
     PATH = "relative_file_path"
@@ -21,14 +27,10 @@ class Dump(Enum):
     TYPE = "type"
     VISIBLE = "visible"
 
-SCHEMA = {"relevant": ["yes", "no"], "state": ["red", "yellow", "green", "off", "unknown"], "type": ["car", "pedestrian", "bicycle", "unknown", "train"], "visible": ["yes", "no"]}
-KEYS = sorted(SCHEMA.keys())
 LABEL = "traffic light"
 FILE_PATTERN = "*/*/*gtFine_polygons.json"
 CLASSES = ["egorel", "eogirel", "pedestr", "bike", "other"]
 
-counts = {l: 0 for l in CLASSES}
-
 def read_json(fn):
     with open(fn, "r") as f:
         data = json.load(f)
@@ -78,44 +80,183 @@ def draw_lights(img_path, objs, outdir, color_func, bw):
         out_path = out_path.replace(".png", "_color.png")
     cv2.imwrite(out_path, arr)
 
-def write_crop(img, tl, cls, outdir):
-    rect = get_rect(tl)
-    # print(rect)
-    # print(img.shape)
-    crop_img = img[rect[1]:rect[3], rect[0]:rect[2]]
-    out_path = os.path.join(outdir, cls, "{:06d}.png".format(counts[cls]))
-    counts[cls] += 1
-    if crop_img.size > 0:
-        cv2.imwrite(out_path, crop_img)
-
-def dump_if_nice(basedir, f, objects, outdir):
-    tls = get_by_label(objects, LABEL)
-    if len(tls) > 0:
-        imgp = os.path.join(basedir, "leftImg8bit", f)
-        imgp = imgp.replace("gtFine_polygons.json", "leftImg8bit.png")
-        if not os.path.exists(imgp):
-            raise FileNotFoundError("{} does not exist".format(imgp))
-        arr = cv2.imread(imgp)
-        for tl in tls:
-            cls = get_label(tl["attributes"])
+def crop_name(f, light_id, obj_idx, unique_id=True):
+    # named after image and light, so reruns and parallel runs produce the same files. Lights
+    # without an id or sharing it with another light of the image are named by object index
+    stem = os.path.basename(f).replace("_gtFine_polygons.json", "")
+    if light_id >= 0 and unique_id:
+        return "{}_{:03d}.png".format(stem, light_id)
+    return "{}_idx{:03d}.png".format(stem, obj_idx)
+
+def make_jobs(basedir, index, outdir):
+    jobs = []
+    for f, rows in index.iter_files():
+        crops = []
+        ids, counts = np.unique(index["id"][rows], return_counts=True)
+        shared = set(ids[counts > 1].tolist())
+        for r in range(rows.start, rows.stop):
+            cls = get_label(index.attributes(r))
             if cls is not None:
-                write_crop(arr, tl, cls, outdir)
+                light_id = int(index["id"][r])
+                out_path = os.path.join(outdir, cls, crop_name(f, light_id, int(index["obj_idx"][r]), light_id not in shared))
+                crops.append(([int(v) for v in index["bbox"][r]], out_path))
+        if crops:
+            jobs.append((tl_index.image_path(basedir, f), crops))
+    return jobs
+
+def cut_crops(store, imgp, crops):
+    rects = [rect for rect, _ in crops]
+    for (_, out_path), crop_img in zip(crops, store.get_crops(imgp, rects)):
+        if crop_img.size > 0:
+            yield out_path, crop_img
+
+def reader(store_args, jobs, crops, events):
+    store = image_access.ImageStore(*store_args)
+    for imgp, job_crops in iter(jobs.get, None):
+        n = 0
+        try:
+            for out_path, crop_img in cut_crops(store, imgp, job_crops):
+                crops.put((imgp, out_path, crop_img))
+                n += 1
+        except Exception as e:
+            # a reader that dies leaves the parent waiting for job queue space, every job has to be answered
+            events.put(("error", imgp, "{}: {}".format(imgp, e)))
+        # sent exactly once per image, also after an error for the crops already queued
+        events.put(("planned", imgp, n))
+
+def writer(crops, events):
+    for imgp, out_path, crop_img in iter(crops.get, None):
+        if not cv2.imwrite(out_path, crop_img):
+            events.put(("error", imgp, "{}: could not write".format(out_path)))
+        events.put(("written", imgp, 1))
+
+class Tracker():
+    # an image is done once its reader planned all crops and the writers wrote every one of them.
+    # Errors only mark an image as failed, every image gets exactly one "planned" event
+    def __init__(self, checkpoint, total):
+        self._checkpoint = checkpoint
+        self._bar = batch_runner.make_progressbar(total, "images")
+        self._pending = {}
+        self._planned = set()
+        self._failed = set()
+        self._finished = set()
+        self.errors = []
+
+    def handle(self, event):
+        kind, imgp, value = event
+        if kind == "error":
+            self.errors.append(value)
+            self._failed.add(imgp)
+        elif kind == "planned":
+            self._pending[imgp] = self._pending.get(imgp, 0) + value
+            self._planned.add(imgp)
+        elif kind == "written":
+            self._pending[imgp] = self._pending.get(imgp, 0) - 1
+        if imgp in self._planned and imgp not in self._finished and self._pending.get(imgp, 0) == 0:
+            self._planned.discard(imgp)
+            self._pending.pop(imgp, None)
+            if imgp not in self._failed:
+                self._checkpoint.mark_done(imgp)
+            self._finished.add(imgp)
+            self._bar.update(len(self._finished))
+
+    def drain(self, q):
+        while True:
+            try:
+                self.handle(q.get_nowait())
+            except queue.Empty:
+                return
+
+    def join_all(self, procs, q):
+        # keep emptying the event queue, a child with unflushed queue data never exits
+        for p in procs:
+            while p.is_alive():
+                self.drain(q)
+                p.join(0.1)
+        self.drain(q)
+
+    def put_job(self, q, job, procs, events):
+        # the job queue is bounded, wait for space while the readers are alive
+        while True:
+            try:
+                q.put(job, timeout=0.1)
+                return
+            except queue.Full:
+                self.drain(events)
+                if not any(p.is_alive() for p in procs):
+                    raise RuntimeError("All reader processes died")
+
+    def finish(self):
+        self._bar.finish()
+
+def dump_crops(jobs, store_args, checkpoint, n_readers=1, n_writers=1, queue_size=256):
+    jobs = [j for j in jobs if not checkpoint.is_done(j[0])]
+    tracker = Tracker(checkpoint, len(jobs))
+    if n_readers <= 1:
+        store = image_access.ImageStore(*store_args)
+        for imgp, crops in jobs:
+            try:
+                for out_path, crop_img in cut_crops(store, imgp, crops):
+                    if not cv2.imwrite(out_path, crop_img):
+                        tracker.handle(("error", imgp, "{}: could not write".format(out_path)))
+            except Exception as e:
+                tracker.handle(("error", imgp, "{}: {}".format(imgp, e)))
+            tracker.handle(("planned", imgp, 0))
+        tracker.finish()
+        return tracker.errors
+    # bounded queues keep only a few decoded frames and crops in flight
+    job_q = multiprocessing.Queue(2 * n_readers)
+    crop_q = multiprocessing.Queue(queue_size)
+    event_q = multiprocessing.Queue()
+    readers = [multiprocessing.Process(target=reader, args=(store_args, job_q, crop_q, event_q)) for _ in range(n_readers)]
+    writers = [multiprocessing.Process(target=writer, args=(crop_q, event_q)) for _ in range(n_writers)]
+    for p in readers + writers:
+        p.start()
+    try:
+        for job in jobs:
+            tracker.put_job(job_q, job, readers, event_q)
+            tracker.drain(event_q)
+        for _ in readers:
+            tracker.put_job(job_q, None, readers, event_q)
+        tracker.join_all(readers, event_q)
+        for _ in writers:
+            crop_q.put(None)
+        tracker.join_all(writers, event_q)
+    except BaseException:
+        for p in readers + writers:
+            p.terminate()
+        raise
+    tracker.finish()
+    return tracker.errors
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("data")
     parser.add_argument("outdir", type=str)
+    parser.add_argument("--index", type=str, help="traffic light index, built from data if it does not exist")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="number of image decoding processes")
+    parser.add_argument("--writers", type=int, help="number of crop encoding processes, defaults to half of --jobs")
+    parser.add_argument("--strips", type=str, help="strip store written by image_access.py, only the rows around the lights are decoded")
+    parser.add_argument("--journal", type=str, help="checkpoint file, an interrupted run resumes from it")
     args = parser.parse_args()
 
     for c in CLASSES:
         ensure_dir(os.path.join(args.outdir, c))
-    os.chdir(os.path.join(args.data, "gtFine"))
-    files = glob.glob(FILE_PATTERN, recursive=True)
-    print(os.getcwd())
-    if not files:
-        raise RuntimeError("No files in " + os.getcwd() + " found")
-    changes = {}
-    for new_f in progressbar(files):
-        j = read_json(new_f)
-        dump_if_nice(args.data, new_f, j, args.outdir)
\ No newline at end of file
+    index = tl_index.open_index(args.data, args.index)
+    n_writers = args.writers if args.writers else max(1, args.jobs // 2)
+    # images are visited once, so the readers get a small cache that only holds strips shared by nearby lights
+    store_args = (args.data, args.strips, 64 * 1024 ** 2)
+    checkpoint = batch_runner.Checkpoint(args.journal, os.path.abspath(args.outdir))
+    jobs = make_jobs(args.data, index, args.outdir)
+    if len(checkpoint):
+        print("Resuming, {} images already done".format(len(checkpoint)), file=sys.stderr)
+    try:
+        errors = dump_crops(jobs, store_args, checkpoint, args.jobs, n_writers)
+    except KeyboardInterrupt:
+        checkpoint.close()
+        sys.exit("Interrupted" + (", rerun with the same journal to resume" if args.journal else ""))
+    checkpoint.close(finished=not errors)
+    for e in sorted(errors):
+        print(e, file=sys.stderr)
+    sys.exit(1 if errors else 0)
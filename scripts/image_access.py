@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import struct
+import multiprocessing
+import collections
+from pathlib import Path
+import numpy as np
+import cv2
+from progressbar import progressbar
+import tl_index
+
+STRIP_MAGIC = b"TLST"
+STRIP_SUFFIX = ".strips"
+STRIP_HEADER = struct.Struct("<4sIIIII")
+STRIP_HEIGHT = 64
+DEFAULT_CACHE_BYTES = 512 * 1024 ** 2
+
+def ensure_dir(d):
+    if os.path.exists(d) and not os.path.isdir(d):
+        raise FileExistsError("{} exists and is not a directory".format(d))
+    Path(d).mkdir(parents=True, exist_ok=True)
+
+class LRUCache():
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._items = collections.OrderedDict()
+
+    def get(self, key):
+        if key not in self._items:
+            return None
+        self._items.move_to_end(key)
+        return self._items[key]
+
+    def put(self, key, arr):
+        if key in self._items:
+            self._bytes -= self._items.pop(key).nbytes
+        if arr.nbytes > self._max_bytes:
+            return
+        self._items[key] = arr
+        self._bytes += arr.nbytes
+        while self._bytes > self._max_bytes:
+            _, old = self._items.popitem(last=False)
+            self._bytes -= old.nbytes
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+def write_strips(image_path, strip_path, strip_height=STRIP_HEIGHT):
+    arr = cv2.imread(image_path)
+    if arr is None:
+        raise FileNotFoundError("{} could not be read".format(image_path))
+    h, w = arr.shape[:2]
+    c = arr.shape[2] if arr.ndim == 3 else 1
+    blobs = []
+    for y in range(0, h, strip_height):
+        ok, buf = cv2.imencode(".png", arr[y:y + strip_height])
+        if not ok:
+            raise RuntimeError("Could not encode strip of " + image_path)
+        blobs.append(buf.tobytes())
+    offsets = np.zeros(len(blobs) + 1, dtype=np.uint64)
+    offsets[1:] = np.cumsum([len(b) for b in blobs])
+    ensure_dir(os.path.dirname(strip_path))
+    tmp = strip_path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(STRIP_HEADER.pack(STRIP_MAGIC, h, w, c, strip_height, len(blobs)))
+        f.write(offsets.tobytes())
+        for b in blobs:
+            f.write(b)
+    os.replace(tmp, strip_path)
+
+class StripFile():
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, "rb")
+        magic, self.height, self.width, self.channels, self.strip_height, n = STRIP_HEADER.unpack(self._f.read(STRIP_HEADER.size))
+        if magic != STRIP_MAGIC:
+            raise ValueError("{} is not a strip file".format(path))
+        self._offsets = np.frombuffer(self._f.read(8 * (n + 1)), dtype=np.uint64)
+        self._data_start = STRIP_HEADER.size + 8 * (n + 1)
+
+    def read_strip(self, i):
+        self._f.seek(self._data_start + int(self._offsets[i]))
+        buf = np.frombuffer(self._f.read(int(self._offsets[i + 1] - self._offsets[i])), dtype=np.uint8)
+        arr = cv2.imdecode(buf, cv2.IMREAD_COLOR) if len(buf) else None
+        if arr is None:
+            raise OSError("{} strip {} could not be decoded".format(self.path, i))
+        return arr
+
+    def strips_for_rows(self, y0, y1):
+        return range(y0 // self.strip_height, (max(y0, y1 - 1)) // self.strip_height + 1)
+
+    def close(self):
+        self._f.close()
+
+def clip_box(box, width, height):
+    x0, y0, x1, y1 = [int(v) for v in box]
+    return max(0, x0), max(0, y0), min(width, x1), min(height, y1)
+
+class ImageStore():
+    def __init__(self, data_dir=None, strip_dir=None, max_bytes=DEFAULT_CACHE_BYTES):
+        self._data_dir = data_dir
+        self._strip_dir = strip_dir
+        self._cache = LRUCache(max_bytes)
+        self.decoded = 0
+
+    def _strip_path(self, image_path):
+        if not self._strip_dir or not self._data_dir:
+            return None
+        path = strip_path_for(self._data_dir, self._strip_dir, image_path)
+        return path if os.path.exists(path) else None
+
+    def get_image(self, image_path):
+        arr = self._cache.get(image_path)
+        if arr is None:
+            if not os.path.exists(image_path):
+                raise FileNotFoundError("{} does not exist".format(image_path))
+            arr = cv2.imread(image_path)
+            if arr is None:
+                raise OSError("{} could not be read".format(image_path))
+            self.decoded += 1
+            self._cache.put(image_path, arr)
+        return arr
+
+    def _get_strip(self, strips, strip_path, i):
+        key = (strip_path, i)
+        arr = self._cache.get(key)
+        if arr is None:
+            arr = strips.read_strip(i)
+            self.decoded += 1
+            self._cache.put(key, arr)
+        return arr
+
+    def get_crops(self, image_path, boxes):
+        # boxes are [x0, y0, x1, y1], crops are copies so they outlive cache eviction
+        strip_path = self._strip_path(image_path)
+        if strip_path is None or self._cache.get(image_path) is not None:
+            arr = self.get_image(image_path)
+            h, w = arr.shape[:2]
+            res = []
+            for box in boxes:
+                x0, y0, x1, y1 = clip_box(box, w, h)
+                res.append(arr[y0:max(y0, y1), x0:max(x0, x1)].copy())
+            return res
+        strips = StripFile(strip_path)
+        try:
+            res = []
+            for box in boxes:
+                x0, y0, x1, y1 = clip_box(box, strips.width, strips.height)
+                if x1 <= x0 or y1 <= y0:
+                    res.append(np.zeros((0, 0, 3), dtype=np.uint8))
+                    continue
+                parts = []
+                for i in strips.strips_for_rows(y0, y1):
+                    top = i * strips.strip_height
+                    part = self._get_strip(strips, strip_path, i)
+                    parts.append(part[max(0, y0 - top):y1 - top, x0:x1])
+                res.append(np.concatenate(parts))
+            return res
+        finally:
+            strips.close()
+
+_default_store = None
+
+def get_crops(image_path, boxes, store=None):
+    global _default_store
+    if store is None:
+        if _default_store is None:
+            _default_store = ImageStore()
+        store = _default_store
+    return store.get_crops(image_path, boxes)
+
+def strip_path_for(data_dir, strip_dir, image_path):
+    rel = os.path.relpath(image_path, os.path.join(data_dir, "leftImg8bit"))
+    return os.path.join(strip_dir, os.path.splitext(rel)[0] + STRIP_SUFFIX)
+
+def _convert(task):
+    image_path, strip_path = task
+    if not os.path.exists(strip_path):
+        write_strips(image_path, strip_path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the leftImg8bit images that contain traffic lights into the strip store")
+    parser.add_argument("data")
+    parser.add_argument("strip_dir")
+    parser.add_argument("--index", type=str, help="traffic light index, built from data if it does not exist")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="number of worker processes")
+    args = parser.parse_args()
+
+    index = tl_index.open_index(args.data, args.index)
+    tasks = []
+    for f, _ in index.iter_files():
+        imgp = tl_index.image_path(args.data, f)
+        tasks.append((imgp, strip_path_for(args.data, args.strip_dir, imgp)))
+    if args.jobs > 1:
+        with multiprocessing.Pool(args.jobs) as pool:
+            for _ in progressbar(pool.imap_unordered(_convert, tasks), max_value=len(tasks)):
+                pass
+    else:
+        for t in progressbar(tasks):
+            _convert(t)
+    print("Converted {} images to {}".format(len(tasks), args.strip_dir))
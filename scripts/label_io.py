@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+import batch_runner
+import tl_schema
+
+LABEL = "traffic light"
+FILE_PATTERN = "gtFine/*/*/*gtFine_polygons.json"
+# keys the labelling tool adds to the objects for display only, they are never written
+TRANSIENT_KEYS = ["depth_metric"]
+GEOMETRY = ["x0", "y0", "x1", "y1", "width", "height", "area"]
+
+def read_json(fn):
+    with open(fn, "r") as f:
+        return json.load(f)
+
+def copy_state(state):
+    # copies everything the tool edits, polygons are never modified in place and stay shared
+    objects = []
+    for o in state["objects"]:
+        o = {k: v for k, v in o.items() if k not in TRANSIENT_KEYS}
+        if "attributes" in o:
+            o["attributes"] = dict(o["attributes"])
+        objects.append(o)
+    return dict(state, objects=objects)
+
+def write_json_atomic(state, fn):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fn), prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f, indent=4, sort_keys=True, allow_nan=False)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates the file private, keep the permissions of the file it replaces
+        if os.path.exists(fn):
+            shutil.copymode(fn, tmp)
+        os.replace(tmp, fn)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def is_light(obj):
+    return obj["label"] == LABEL and not ("deleted" in obj.keys() and int(obj["deleted"]) != 0)
+
+def light_table(objects):
+    # one row per light, the bounding box and every schema field as columns. Attribute columns
+    # hold the raw values (None if missing), so "type == 'car'" compares elementwise
+    idx = [i for i, obj in enumerate(objects) if is_light(obj)]
+    boxes = np.zeros((len(idx), 4), dtype=np.float32)
+    for row, i in enumerate(idx):
+        x, y = zip(*objects[i]["polygon"])
+        boxes[row] = min(x), min(y), max(x), max(y)
+    table = {"idx": np.array(idx, dtype=np.int32)}
+    for i, k in enumerate(GEOMETRY[:4]):
+        table[k] = boxes[:, i]
+    table["width"] = table["x1"] - table["x0"]
+    table["height"] = table["y1"] - table["y0"]
+    table["area"] = table["width"] * table["height"]
+    for f in tl_schema.FIELDS:
+        col = np.empty(len(idx), dtype=object)
+        col[:] = [objects[i].get("attributes", {}).get(f.name) for i in idx]
+        table[f.name] = col
+    return table
+
+def select(table, where):
+    # where is a callable on the table or a numpy expression over its columns, e.g. "(height / width < 1.5) & (type == 'car')"
+    n = len(table["idx"])
+    if where is None:
+        return np.ones(n, dtype=bool)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if callable(where):
+            mask = where(table)
+        else:
+            mask = eval(where, {"__builtins__": {}, "np": np}, dict(table))
+    return np.broadcast_to(np.asarray(mask, dtype=bool), (n,))
+
+class LabelIO():
+    def __init__(self, file, state=None, depth_data=None, fill_defaults=True):
+        # state can be handed in already parsed, e.g. by the prefetcher. The labelling tool fills in
+        # the defaults of missing attributes, bulk edits leave lights they do not select untouched
+        self._file = file
+        self._state = state
+        self._dirty = False
+        self._depth_data = depth_data if depth_data is not None else {}
+        if self._state is None:
+            if not os.path.exists(file):
+                raise RuntimeError("Could not find " + file)
+            self._state = read_json(file)
+        if fill_defaults:
+            self._validate()
+
+    def _set(self, idx, name, value):
+        if self._state["objects"][idx]["label"] != LABEL:
+            raise ValueError("Idx {} not a traffic light".format(idx))
+        if tl_schema.FIELD_BY_NAME[name].encode(value) == tl_schema.INVALID:
+            raise ValueError("{} is not a valid value for {}".format(value, name))
+        attrs = self._state["objects"][idx].setdefault("attributes", {})
+        if name not in attrs or attrs[name] != value:
+            attrs[name] = value
+            self._dirty = True
+
+    def _get(self, idx, name):
+        return self._state["objects"][idx]["attributes"][name]
+
+    def set_type(self, idx, t):
+        self._set(idx, "type", t)
+
+    def set_state(self, idx, t):
+        self._set(idx, "state", t)
+
+    def set_relevant(self, idx):
+        new_val = "yes" if self._get(idx, "relevant") == "no" else "no"
+        self._set(idx, "relevant", new_val)
+
+    def set_lane_relevant(self, idx):
+        new_val = "yes" if self._get(idx, "lane_relevant") == "no" else "no"
+        self._set(idx, "lane_relevant", new_val)
+
+    def set_visible(self, idx):
+        new_val = "yes" if self._get(idx, "visible") == "no" else "no"
+        self._set(idx, "visible", new_val)
+
+    def set_depth(self, idx, depth):
+        self._set(idx, "depth", depth)
+
+    def table(self):
+        return light_table(self._state["objects"])
+
+    def set_many(self, idxs, values, dry_run=False):
+        # sets every name: value of values on the lights idxs, returns the changes as
+        # {"idx", "key", "old", "new"}. With dry_run nothing is modified
+        for name, value in values.items():
+            if tl_schema.FIELD_BY_NAME[name].encode(value) == tl_schema.INVALID:
+                raise ValueError("{} is not a valid value for {}".format(value, name))
+        changes = []
+        for idx in idxs:
+            idx = int(idx)
+            attrs = self._state["objects"][idx].get("attributes", {})
+            for name, value in values.items():
+                if name not in attrs or attrs[name] != value:
+                    changes.append({"idx": idx, "key": name, "old": attrs.get(name), "new": value})
+                    if not dry_run:
+                        self._set(idx, name, value)
+        return changes
+
+    def update_where(self, where, values, dry_run=False):
+        table = self.table()
+        return self.set_many(table["idx"][select(table, where)], values, dry_run)
+
+    def is_dirty(self):
+        return self._dirty
+
+    def write(self):
+        write_json_atomic(copy_state(self._state), self._file)
+        self._dirty = False
+
+    def save(self, writer=None):
+        # only edited files are written, in the background if a writer is given
+        if not self._dirty:
+            return False
+        if writer:
+            writer.submit(self._file, copy_state(self._state))
+            self._dirty = False
+        else:
+            self.write()
+        return True
+
+    def get_lights(self):
+        res = {}
+        for idx, obj in enumerate(self._state["objects"]):
+            if is_light(obj):
+                res[idx] = obj
+                res[idx]["depth_metric"] = self._depth_data[idx] if idx in self._depth_data.keys() else 0
+        return res
+
+    def delete_by_idx(self, tl_idx):
+        del self._state["objects"][tl_idx]
+        self._dirty = True
+
+    def _validate(self):
+        for idx, l in self.get_lights().items():
+            tl_schema.fill_defaults(l.setdefault("attributes", {}))
+
+def list_files(basedir, cities=None):
+    # label files relative to basedir, cities are given as "aachen" or "train/aachen"
+    files = sorted(os.path.relpath(f, basedir) for f in glob.glob(os.path.join(basedir, FILE_PATTERN)))
+    if cities:
+        files = [f for f in files if f.split("/")[2] in cities or "/".join(f.split("/")[1:3]) in cities]
+    return files
+
+def edit_file(task):
+    basedir, fn, where, values, dry_run = task
+    io = LabelIO(os.path.join(basedir, fn), fill_defaults=False)
+    changes = io.update_where(where, values, dry_run)
+    if not dry_run:
+        io.save()
+    return changes
+
+def edit_files(basedir, files, where, values, dry_run=False, jobs=1, journal=None):
+    # applies values to the selected lights of every file, returns file -> changes of the changed files.
+    # where must be picklable for jobs > 1, i.e. an expression or a module level function
+    res = {}
+    def collect(fn, changes):
+        if changes:
+            res[fn] = changes
+    tasks = [(basedir, f, where, values, dry_run) for f in files]
+    signature = "{} {} {}".format(os.path.abspath(basedir), where, json.dumps(values, sort_keys=True))
+    batch_runner.run_batch(edit_file, tasks, files, journal, signature, jobs, on_result=collect)
+    return res
+
+def parse_value(name, text):
+    # command line values are strings, the schema also has int fields
+    if name not in tl_schema.FIELD_BY_NAME:
+        raise ValueError("Unknown attribute " + name)
+    for v in tl_schema.values(name):
+        if str(v) == text:
+            return v
+    raise ValueError("{} is not a valid value for {}, expected one of {}".format(text, name, ", ".join(str(v) for v in tl_schema.values(name))))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Set attributes of all traffic lights matching an expression")
+    parser.add_argument("basedir")
+    parser.add_argument("--set", action="append", required=True, metavar="KEY=VALUE", help="attribute to set, can be given multiple times")
+    parser.add_argument("--where", type=str, help="numpy expression over the columns {} and the attributes, e.g. \"(height / width < 1.5) & (type == 'car')\"".format(", ".join(GEOMETRY)))
+    parser.add_argument("--city", action="append", help="only edit this city, can be given multiple times")
+    parser.add_argument("--dry-run", action="store_true", help="only print the changes")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--journal", type=str, help="checkpoint file, an interrupted run resumes from it")
+    args = parser.parse_args()
+
+    values = {}
+    for s in args.set:
+        name, _, text = s.partition("=")
+        try:
+            values[name] = parse_value(name, text)
+        except ValueError as e:
+            parser.error(str(e))
+    files = list_files(args.basedir, args.city)
+    if not files:
+        raise RuntimeError("No files in " + args.basedir + " found")
+    try:
+        res = edit_files(args.basedir, files, args.where, values, args.dry_run, args.jobs, None if args.dry_run else args.journal)
+    except KeyboardInterrupt:
+        sys.exit("Interrupted")
+    for fn in sorted(res):
+        for c in res[fn]:
+            print("{} {}: {} {} -> {}".format(fn, c["idx"], c["key"], c["old"], c["new"]))
+    n = sum(len({c["idx"] for c in changes}) for changes in res.values())
+    print("{} {} lights in {} of {} files".format("Would change" if args.dry_run else "Changed", n, len(res), len(files)))
@@ -1,70 +1,170 @@
 #!/usr/bin/env python3
 
 import json
-from enum import Enum, auto
+import csv
+import sys
+import os
+import time
+import signal
+import collections
 import glob
 import argparse
-from progressbar import progressbar
-
-class LabelError(Enum):
-    NO_ATTRIBUTES = auto()
-    MISSING_TAG = auto()
-    INVALID_TAG = auto()
-    MISSING_VALUE = auto()
-    INVALID_VALUE = auto()
-
-SCHEMA = {"relevant": ["yes", "no"], "state": ["red", "yellow", "green", "off", "unknown"], "type": ["car", "pedestrian", "bicycle", "unknown", "train"], "visible": ["yes", "no"]}
-KEYS = sorted(SCHEMA.keys())
-LABEL = "traffic light"
+import batch_runner
+import tl_schema
+from tl_schema import LabelError
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+LABEL = tl_schema.LABEL
 FILE_PATTERN = "/gtFine/*/*/*gtFine_polygons.json"
+CITY_PATTERN = "/gtFine/*/*/"
+LABEL_SUFFIX = "gtFine_polygons.json"
+REPORT_FIELDS = ["file", "obj_idx", "id", "code", "key", "value"]
 
 def get_by_label(labels, label):
-    return [obj for obj in labels["objects"] if obj["label"] == label and not ("deleted" in obj.keys() and obj["deleted"])]
-
-def check_keys(comp):
-    errs = []
-    for c in comp:
-        if c not in KEYS:
-            errs.append((LabelError.INVALID_TAG, c))
-    for k in KEYS:
-        if k not in comp:
-            errs.append((LabelError.MISSING_TAG, k))
-    return errs
-
-def check_values(key, choices, actual):
-    if not actual:
-        return [(LabelError.MISSING_VALUE, (key, actual))]
-    if actual not in choices:
-        return [(LabelError.INVALID_VALUE, (key, actual))]
-    return []
-
-def check_attr_map(attrs):
-    errs = []
-    comp = sorted(attrs.keys())
-    errs += check_keys(comp)
-    for k in KEYS:
-        if k in comp:
-            errs += check_values(k, SCHEMA[k], attrs[k])
-    return errs
-
-def check_attributes(obj):
-    errs = []
-    if not "attributes" in obj.keys():
-        errs.append([(LabelError.NO_ATTRIBUTES)])
-        return errs
-    errs += check_attr_map(obj["attributes"])
-    return errs
+    return [(idx, obj) for idx, obj in enumerate(labels["objects"]) if obj["label"] == label and not ("deleted" in obj.keys() and obj["deleted"])]
 
 def check_file(fn):
-    with open(fn, "r") as f:
-        labels = json.load(f)
-        return [(int(obj["id"]) if "id" in obj.keys() else None,  check_attributes(obj)) for obj in get_by_label(labels, LABEL) if check_attributes(obj) != []]
+    # (object index, id, errors) of every light with at least one error, each light is checked once
+    try:
+        with open(fn, "r") as f:
+            labels = json.load(f)
+    except (OSError, ValueError) as e:
+        return [(None, None, [(LabelError.INVALID_FILE, str(e))])]
+    res = []
+    for idx, obj in get_by_label(labels, LABEL):
+        errs = tl_schema.check_attributes(obj)
+        if errs:
+            res.append((idx, int(obj["id"]) if "id" in obj.keys() else None, errs))
+    return res
+
+def error_record(fn, idx, lid, err):
+    code, detail = err
+    key, value = None, None
+    if code in (LabelError.MISSING_TAG, LabelError.INVALID_TAG):
+        key = detail
+    elif code in (LabelError.MISSING_VALUE, LabelError.INVALID_VALUE):
+        key, value = detail
+    elif code == LabelError.INVALID_FILE:
+        value = detail
+    return {"file": fn, "obj_idx": idx, "id": lid, "code": code.name, "key": key, "value": value}
+
+def file_records(fn, errmap):
+    return [error_record(fn, idx, lid, err) for idx, lid, errs in errmap for err in errs]
+
+def validate(files, jobs=1):
+    # error records of all files, in file order
+    results = batch_runner.run_batch(_check_file, files, files, jobs=jobs)
+    results.sort(key=lambda r: r[0])
+    return [r for fn, errmap in results for r in file_records(fn, errmap)]
+
+def _check_file(fn):
+    return fn, check_file(fn)
+
+def count_codes(records):
+    counts = collections.Counter(r["code"] for r in records)
+    return {e.name: counts[e.name] for e in LabelError}
+
+def write_jsonl(records, counts, fn):
+    # reports are replaced atomically, a watcher may rewrite them while someone reads them
+    with open(fn + ".tmp", "w") as f:
+        for r in records:
+            f.write(json.dumps(r) + "\n")
+        f.write(json.dumps({"summary": counts}) + "\n")
+    os.replace(fn + ".tmp", fn)
+
+def write_csv(records, fn):
+    with open(fn + ".tmp", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(records)
+    os.replace(fn + ".tmp", fn)
+
+class ErrorIndex():
+    # live map of file -> error records, updated per file by the watch mode
+    def __init__(self, records=()):
+        self._errors = {}
+        for r in records:
+            self._errors.setdefault(r["file"], []).append(r)
+
+    def update(self, fn, records):
+        # returns the records that appeared and the ones that were fixed
+        old = self._errors.pop(fn, [])
+        if records:
+            self._errors[fn] = records
+        return [r for r in records if r not in old], [r for r in old if r not in records]
+
+    def remove(self, fn):
+        return self._errors.pop(fn, [])
+
+    def records(self):
+        return [r for fn in sorted(self._errors) for r in self._errors[fn]]
+
+    def __len__(self):
+        return sum(len(v) for v in self._errors.values())
+
+def scan_files(basedir):
+    # (mtime, size) of every label file, scandir avoids a stat call per file on most file systems
+    res = {}
+    for d in glob.glob(basedir + CITY_PATTERN):
+        with os.scandir(d) as it:
+            for e in it:
+                if e.name.endswith(LABEL_SUFFIX):
+                    st = e.stat()
+                    res[os.path.normpath(e.path)] = (st.st_mtime_ns, st.st_size)
+    return res
+
+def poll_changes(basedir, interval):
+    # yields (changed, removed) file lists
+    known = scan_files(basedir)
+    while True:
+        time.sleep(interval)
+        current = scan_files(basedir)
+        changed = sorted(f for f, s in current.items() if known.get(f) != s)
+        removed = sorted(f for f in known if f not in current)
+        known = current
+        if changed or removed:
+            yield changed, removed
+
+def inotify_changes(basedir, interval):
+    flags = inotify_simple.flags
+    ino = inotify_simple.INotify()
+    # atomic writers rename into place, so MOVED_TO counts as a write
+    mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.DELETE | flags.MOVED_FROM
+    dirs = {ino.add_watch(d, mask): d for d in glob.glob(basedir + CITY_PATTERN)}
+    while True:
+        changed, removed = set(), set()
+        # read_delay collects the events of a burst of saves into one batch
+        for ev in ino.read(read_delay=int(interval * 1000)):
+            if not ev.name.endswith(LABEL_SUFFIX) or ev.wd not in dirs:
+                continue
+            fn = os.path.normpath(os.path.join(dirs[ev.wd], ev.name))
+            if ev.mask & (flags.DELETE | flags.MOVED_FROM):
+                removed.add(fn)
+                changed.discard(fn)
+            else:
+                changed.add(fn)
+                removed.discard(fn)
+        if changed or removed:
+            yield sorted(changed), sorted(removed)
+
+def watch(basedir, index, interval, on_update):
+    changes = inotify_changes(basedir, interval) if inotify_simple else poll_changes(basedir, interval)
+    for changed, removed in changes:
+        for fn in removed:
+            on_update(fn, [], index.remove(fn))
+        for fn in changed:
+            on_update(fn, *index.update(fn, file_records(fn, check_file(fn))))
 
 def to_string(err):
     if err[0] == LabelError.NO_ATTRIBUTES:
         return "no attributes found"
     if err[0] == LabelError.MISSING_TAG:
         return "Tag \"{}\" not found".format(err[1])
+    if err[0] == LabelError.INVALID_FILE:
+        return "File could not be read: {}".format(err[1])
     if err[0] == LabelError.MISSING_VALUE:
         return "Value \"{}\" not found".format(err[1])
     if err[0] == LabelError.INVALID_TAG:
@@ -74,26 +174,70 @@ def to_string(err):
     else:
         raise RuntimeError("invalid error code")
 
+def record_string(r):
+    detail = {LabelError.MISSING_TAG: r["key"], LabelError.INVALID_TAG: r["key"], LabelError.INVALID_FILE: r["value"]}
+    code = LabelError[r["code"]]
+    return "File {} item ID {}: {}\n".format(r["file"], r["id"], to_string((code, detail.get(code, (r["key"], r["value"])))))
+
+def write_reports(args, records):
+    counts = count_codes(records)
+    if args.jsonl:
+        write_jsonl(records, counts, args.jsonl)
+    if args.csv:
+        write_csv(records, args.csv)
+    msg = [record_string(r) for r in records]
+    if args.outfile:
+        with open(args.outfile, "w") as f:
+            f.writelines(msg)
+    elif not args.jsonl and not args.csv and not args.watch:
+        for l in msg:
+            print(l)
+    return counts
+
+def print_summary(records, counts, n_total):
+    n_files = len({r["file"] for r in records})
+    print("{} errors in {} of {} files".format(len(records), n_files, n_total), file=sys.stderr)
+    for code, n in counts.items():
+        if n:
+            print("  {}: {}".format(code, n), file=sys.stderr)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("basedir")
-    parser.add_argument("--outfile", "-o", type=str)
+    parser.add_argument("--outfile", "-o", type=str, help="human readable error list, printed if neither this nor a report is given")
+    parser.add_argument("--jsonl", type=str, help="write one json line per error and a final summary line")
+    parser.add_argument("--csv", type=str, help="write one csv row per error")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--watch", action="store_true", help="keep running and re-check label files when they change, reports are rewritten after each change")
+    parser.add_argument("--interval", type=float, default=0.5, help="polling interval of the watch mode in seconds")
     args = parser.parse_args()
 
-    files = glob.glob(args.basedir + FILE_PATTERN)
+    files = sorted(glob.glob(args.basedir + FILE_PATTERN))
     if not files:
         raise RuntimeError("No files in " + args.basedir + " found")
-    msg = []
-    for f in progressbar(files):
-        errmap = check_file(f)
-        for lid, errlist in errmap:
-            if errlist:
-                print(errmap)
-                for err in errlist:
-                    msg.append("File {} item ID {}: {}\n".format(f, lid, to_string(err)))
-    if args.outfile:
-        with open(args.outfile, "w") as f:
-            f.writelines(msg)
-    else:
-        for l in msg:
-            print(l)
+    records = validate(files, args.jobs)
+    counts = write_reports(args, records)
+    print_summary(records, counts, len(files))
+    if args.watch:
+        index = ErrorIndex([dict(r, file=os.path.normpath(r["file"])) for r in records])
+
+        def on_update(fn, added, fixed):
+            for r in fixed:
+                print("Fixed: " + record_string(r), end="")
+            for r in added:
+                print(record_string(r), end="")
+            sys.stdout.flush()
+            if added or fixed:
+                write_reports(args, index.records())
+
+        if hasattr(signal, "SIGUSR1"):
+            # kill -USR1 <pid> dumps the current error index
+            signal.signal(signal.SIGUSR1, lambda *_: print_summary(index.records(), write_reports(args, index.records()), len(scan_files(args.basedir))))
+        print("Watching {} ({})".format(args.basedir, "inotify" if inotify_simple else "polling"), file=sys.stderr)
+        try:
+            watch(args.basedir, index, args.interval, on_update)
+        except KeyboardInterrupt:
+            pass
+        records = index.records()
+    # non-zero exit code if anything failed, usable as a release gate
+    sys.exit(1 if records else 0)
@@ -3,21 +3,82 @@
 import json
 import argparse
 import os
-from progressbar import progressbar
+import sys
+import batch_runner
 from pathlib import Path
 import glob
+import numpy as np
 
 LABEL = "traffic light"
 FILE_PATTERN = "gtFine/*/*/*gtFine_polygons.json"
+WILDCARD = "*"
+CHANGES_SUFFIX = ".jsonl"
+FORMATS = ["cityscapes", "coco", "yolo", "npz"]
 
-def my_marginalization(object):
-    if not "relevant" in object["attributes"].keys():
-        return
-    if object["attributes"]["relevant"] == "yes":
-        object["label"] = "tl relevant"
-    else:
-        object["label"] = "tl irrelevant"
-    return object
+# a rule table maps attribute combinations to output labels, first matching rule wins.
+# "*" matches any value, a missing attribute only matches "*" or null. A label of null drops
+# the light, lights matching no rule get "default" or stay unchanged if there is none.
+DEFAULT_RULES = {
+    "name": "relevance",
+    "keys": ["relevant"],
+    "rules": [
+        {"match": {"relevant": "yes"}, "label": "tl relevant"},
+        {"match": {"relevant": "no"}, "label": "tl irrelevant"},
+    ],
+}
+
+class Keep():
+    def __repr__(self):
+        return "KEEP"
+
+    def __reduce__(self):
+        # unpickles to the module singleton, so "is KEEP" also holds in worker processes
+        return "KEEP"
+
+KEEP = Keep()
+
+class RuleTable():
+    def __init__(self, spec):
+        self.name = spec.get("name", "marginalized")
+        self.keys = list(spec["keys"])
+        self._rules = []
+        for rule in spec["rules"]:
+            unknown = set(rule["match"].keys()) - set(self.keys)
+            if unknown:
+                raise ValueError("Rule {} in {} uses keys {} not listed in keys".format(rule, self.name, sorted(unknown)))
+            self._rules.append((tuple(rule["match"].get(k, WILDCARD) for k in self.keys), rule["label"]))
+        self._default = spec["default"] if "default" in spec else KEEP
+        self._lookup = {}
+
+    @property
+    def classes(self):
+        # detector classes in order of first appearance, lights without a rule keep the original label
+        res = []
+        for label in [l for _, l in self._rules] + [self._default]:
+            if label is KEEP:
+                label = LABEL
+            if label is not None and label not in res:
+                res.append(label)
+        return res
+
+    def _match(self, values):
+        for pattern, label in self._rules:
+            if all(p == WILDCARD or p == v for p, v in zip(pattern, values)):
+                return label
+        return self._default
+
+    def resolve(self, attrs):
+        # every attribute combination is matched against the rule list only once
+        values = tuple(attrs.get(k) for k in self.keys)
+        if values not in self._lookup:
+            self._lookup[values] = self._match(values)
+        return self._lookup[values]
+
+def load_rules(fn):
+    spec = read_json(fn)
+    if "name" not in spec:
+        spec["name"] = Path(fn).stem
+    return RuleTable(spec)
 
 def read_json(fn):
     with open(fn, "r") as f:
@@ -29,27 +90,192 @@ def ensure_dir(d):
         raise FileExistsError("{} exists and is not a directory".format(d))
     Path(d).mkdir(parents=True, exist_ok=True)
 
-def update_objects(objects, func, label=LABEL):
+def apply_rules(objects, table, label=LABEL):
+    # returns the new object list and the changes as (index, new label or None for dropped)
+    res = []
+    changes = []
     for i, obj in enumerate(objects):
-        if obj["label"] == label:
-            objects[i] = func(obj)
+        if obj["label"] != label:
+            res.append(obj)
+            continue
+        new_label = table.resolve(obj.get("attributes", {}))
+        if new_label is KEEP or new_label == obj["label"]:
+            res.append(obj)
+        elif new_label is None:
+            changes.append((i, None))
+        else:
+            res.append(dict(obj, label=new_label))
+            changes.append((i, new_label))
+    return res, changes
+
+def export_lights(objects, table, label=LABEL):
+    # (label, polygon) of every non-deleted light that is not dropped by the table
+    res = []
+    for obj in objects:
+        if obj["label"] != label or ("deleted" in obj.keys() and obj["deleted"]):
+            continue
+        new_label = table.resolve(obj.get("attributes", {}))
+        if new_label is None:
+            continue
+        res.append((obj["label"] if new_label is KEEP else new_label, obj["polygon"]))
+    return res
+
+def to_bbox(poly):
+    x, y = zip(*poly)
+    return [min(x), min(y), max(x), max(y)]
+
+def image_file(fn):
+    return os.path.join("leftImg8bit", os.path.relpath(fn, "gtFine")).replace("gtFine_polygons.json", "leftImg8bit.png")
+
+def write_yolo(lights, classes, size, fn):
+    w, h = size
+    ensure_dir(os.path.dirname(fn))
+    with open(fn, "w") as f:
+        for label, poly in lights:
+            x0, y0, x1, y1 = to_bbox(poly)
+            f.write("{} {:.6f} {:.6f} {:.6f} {:.6f}\n".format(classes.index(label), (x0 + x1) / 2 / w, (y0 + y1) / 2 / h, (x1 - x0) / w, (y1 - y0) / h))
+
+def yolo_file(target_dir, fn):
+    return os.path.join(target_dir, "yolo", "labels", os.path.relpath(image_file(fn), "leftImg8bit")).replace(".png", ".txt")
+
+def dump_json(data, fn, compact):
+    ensure_dir(os.path.dirname(fn))
+    with open(fn, "w") as t:
+        if compact:
+            json.dump(data, t, sort_keys=True, separators=(",", ":"))
+        else:
+            json.dump(data, t, indent=4, sort_keys=True)
+
+# rule tables of the current run, set once per worker so every table builds its lookup only once
+_tables = []
+
+def init_tables(tables):
+    global _tables
+    _tables = tables
+
+def marginalize_file(task):
+    basedir, target_dirs, old_f, compact, changed_only, formats = task
+    data = read_json(os.path.join(basedir, old_f))
+    size = data["imgWidth"], data["imgHeight"]
+    res = []
+    for table, target_dir in zip(_tables, target_dirs):
+        if changed_only:
+            res.append(apply_rules(data["objects"], table)[1])
+            continue
+        if "cityscapes" in formats:
+            objects, _ = apply_rules(data["objects"], table)
+            dump_json(dict(data, objects=objects), os.path.join(target_dir, old_f), compact)
+        lights = export_lights(data["objects"], table) if set(formats) - {"cityscapes"} else []
+        if "yolo" in formats:
+            write_yolo(lights, table.classes, size, yolo_file(target_dir, old_f))
+        # only the aggregated formats need the lights back in the main process
+        res.append((size, [(table.classes.index(l), to_bbox(p), p) for l, p in lights]) if {"coco", "npz"} & set(formats) else None)
+    return res
+
+class Collector():
+    # gathers the lights of every file for the formats that end up in a single file
+    def __init__(self, n_tables):
+        self._files = [{} for _ in range(n_tables)]
+
+    def __call__(self, fn, res):
+        for files, item in zip(self._files, res):
+            if item is not None:
+                files[fn] = item
+
+    def sorted_files(self, table_i):
+        return sorted(self._files[table_i].items())
+
+def write_coco(files, classes, fn):
+    coco = {"images": [], "annotations": [], "categories": [{"id": i + 1, "name": c, "supercategory": LABEL} for i, c in enumerate(classes)]}
+    for img_id, (f, (size, lights)) in enumerate(files, 1):
+        coco["images"].append({"id": img_id, "file_name": image_file(f), "width": size[0], "height": size[1]})
+        for cls, (x0, y0, x1, y1), poly in lights:
+            coco["annotations"].append({"id": len(coco["annotations"]) + 1, "image_id": img_id, "category_id": cls + 1,
+                                        "bbox": [x0, y0, x1 - x0, y1 - y0], "area": (x1 - x0) * (y1 - y0),
+                                        "segmentation": [[v for p in poly for v in p]], "iscrowd": 0})
+    ensure_dir(os.path.dirname(fn))
+    with open(fn, "w") as f:
+        json.dump(coco, f, separators=(",", ":"))
+
+def write_npz(files, classes, fn):
+    ann_image = [i for i, (_, (_, lights)) in enumerate(files) for _ in lights]
+    ann = [light for _, (_, lights) in files for light in lights]
+    ensure_dir(os.path.dirname(fn))
+    np.savez(fn,
+             classes=np.array(classes),
+             files=np.array([image_file(f) for f, _ in files]),
+             image_size=np.array([size for _, (size, _) in files], dtype=np.int32).reshape(-1, 2),
+             image=np.array(ann_image, dtype=np.int32),
+             bbox=np.array([b for _, b, _ in ann], dtype=np.float32).reshape(-1, 4),
+             class_id=np.array([c for c, _, _ in ann], dtype=np.int16))
+
+class ChangeWriter():
+    # one json line per changed light and variant, written from the main process only
+    def __init__(self, target_dirs, resume):
+        self._files = []
+        for d in target_dirs:
+            ensure_dir(os.path.dirname(d) or ".")
+            self._files.append(open(d + CHANGES_SUFFIX, "a" if resume else "w"))
+
+    def __call__(self, fn, res):
+        for f, changes in zip(self._files, res):
+            for idx, label in changes:
+                f.write(json.dumps({"file": fn, "idx": idx, "label": label}) + "\n")
+            f.flush()
+
+    def close(self):
+        for f in self._files:
+            f.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("basedir")
     parser.add_argument("target_dir")
+    parser.add_argument("--rules", action="append", help="json rule table, can be given multiple times to write one variant per table in a single pass")
+    parser.add_argument("--changed-only", action="store_true", help="only write the changed lights to <target_dir>/<variant>" + CHANGES_SUFFIX)
+    parser.add_argument("--compact", action="store_true", help="write label files without indentation")
+    parser.add_argument("--format", action="append", choices=FORMATS, help="output format, can be given multiple times (default: cityscapes)")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--journal", type=str, help="checkpoint file, an interrupted run resumes from it")
     args = parser.parse_args()
+    formats = args.format if args.format else ["cityscapes"]
+    if args.journal and {"coco", "npz"} & set(formats):
+        parser.error("--journal cannot be used with coco or npz output, they are written at the end of the run")
+    if args.changed_only and formats != ["cityscapes"]:
+        parser.error("--changed-only cannot be combined with --format")
 
-    old_wd = os.getcwd()
-    os.chdir(args.basedir)
-    files = glob.glob(FILE_PATTERN)
+    tables = [load_rules(r) for r in args.rules] if args.rules else [RuleTable(DEFAULT_RULES)]
+    names = [t.name for t in tables]
+    if len(set(names)) != len(names):
+        raise ValueError("Rule table names must be unique, got " + ", ".join(names))
+    target_dir = os.path.abspath(args.target_dir)
+    if args.changed_only or len(tables) > 1:
+        target_dirs = [os.path.join(target_dir, n) for n in names]
+    else:
+        target_dirs = [target_dir]
+    files = sorted(os.path.relpath(f, args.basedir) for f in glob.glob(os.path.join(args.basedir, FILE_PATTERN)))
     if not files:
         raise RuntimeError("No files in " + args.basedir + " found")
-    for old_f in progressbar(files):
-        data = read_json(old_f)
-        update_objects(data["objects"], my_marginalization)
-        target_file = os.path.join(args.target_dir, old_f)
-        ensure_dir(os.path.dirname(target_file))
-        with open(target_file, "w") as t:
-            json.dump(data, t, indent=4, sort_keys=True)
-
+    tasks = [(args.basedir, target_dirs, f, args.compact, args.changed_only, formats) for f in files]
+    if args.changed_only:
+        writer = ChangeWriter(target_dirs, args.journal and os.path.exists(args.journal))
+    else:
+        writer = Collector(len(tables))
+    signature = "{} {} {}".format(target_dir, " ".join(names), " ".join(formats))
+    try:
+        batch_runner.run_batch(marginalize_file, tasks, files, args.journal, signature, args.jobs, on_result=writer,
+                               initializer=init_tables, initargs=(tables,))
+    except KeyboardInterrupt:
+        sys.exit("Interrupted")
+    finally:
+        if args.changed_only:
+            writer.close()
+    for i, (table, d) in enumerate(zip(tables, target_dirs)):
+        if "coco" in formats:
+            write_coco(writer.sorted_files(i), table.classes, os.path.join(d, "coco.json"))
+        if "npz" in formats:
+            write_npz(writer.sorted_files(i), table.classes, os.path.join(d, "annotations.npz"))
+        if "yolo" in formats:
+            ensure_dir(os.path.join(d, "yolo"))
+            with open(os.path.join(d, "yolo", "classes.txt"), "w") as f:
+                f.write("\n".join(table.classes) + "\n")
@@ -12,6 +12,8 @@ import itertools
 from PIL import Image
 import cv2
 from pathlib import Path
+import tl_index
+import image_access
 
 class Dump(Enum):
     PATH = "relative_file_path"
@@ -21,8 +23,6 @@ class Dump(Enum):
     TYPE = "type"
     VISIBLE = "visible"
 
-SCHEMA = {"relevant": ["yes", "no"], "state": ["red", "yellow", "green", "off", "unknown"], "type": ["car", "pedestrian", "bicycle", "unknown", "train"], "visible": ["yes", "no"]}
-KEYS = sorted(SCHEMA.keys())
 LABEL = "traffic light"
 FILE_PATTERN = "*/*/*gtFine_polygons.json"
 
@@ -56,20 +56,17 @@ def ensure_dir(d):
         raise FileExistsError("{} exists and is not a directory".format(d))
     Path(d).mkdir(parents=True, exist_ok=True)
 
-def get_rect(obj):
-    x,y = list(zip(*obj["polygon"]))
-    return (int(min(x)), int(min(y))), (int(max(x)), int(max(y)))
+def get_rect(bbox):
+    return (int(bbox[0]), int(bbox[1])), (int(bbox[2]), int(bbox[3]))
 
-def draw_lights(img_path, objs, outdir, color_func, bw):
-    if not os.path.exists(img_path):
-        raise FileNotFoundError("{} does not exist".format(img_path))
-    arr = cv2.imread(img_path)
+def draw_lights(store, img_path, lights, outdir, color_func, bw):
+    arr = store.get_image(img_path).copy()
     if bw:
         arr = cv2.cvtColor(arr, cv2.COLOR_BGR2GRAY)
         arr = cv2.cvtColor(arr, cv2.COLOR_GRAY2BGR)
-    for tl in objs:
-        p1, p2 = get_rect(tl)
-        cv2.rectangle(arr, p1, p2, color_func(tl["attributes"]), thickness=2)
+    for bbox, attrs in lights:
+        p1, p2 = get_rect(bbox)
+        cv2.rectangle(arr, p1, p2, color_func(attrs), thickness=2)
     out_path = os.path.join(outdir, os.path.basename(img_path))
     if bw:
         out_path = out_path.replace(".png", "_bw.png")
@@ -77,28 +74,24 @@ def draw_lights(img_path, objs, outdir, color_func, bw):
         out_path = out_path.replace(".png", "_color.png")
     cv2.imwrite(out_path, arr)
 
-def dump_if_nice(basedir, f, objects, outdir):
-    tls = get_by_label(objects, LABEL)
-    if len(tls) > 17:
-        imgp = os.path.join(basedir, "leftImg8bit", f)
-        imgp = imgp.replace("gtFine_polygons.json", "leftImg8bit.png")
-        draw_lights(imgp, tls, outdir, get_color, False)
-        draw_lights(imgp, tls, outdir, get_color_orig, True)
+def dump_if_nice(store, basedir, index, f, rows, outdir):
+    if rows.stop - rows.start > 17:
+        imgp = tl_index.image_path(basedir, f)
+        tls = [(index["bbox"][r], index.attributes(r)) for r in range(rows.start, rows.stop)]
+        draw_lights(store, imgp, tls, outdir, get_color, False)
+        draw_lights(store, imgp, tls, outdir, get_color_orig, True)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("data")
     parser.add_argument("outdir", type=str)
+    parser.add_argument("--index", type=str, help="traffic light index, built from data if it does not exist")
     args = parser.parse_args()
 
     ensure_dir(args.outdir)
-    old_wd = os.getcwd()
-    os.chdir(os.path.join(args.data, "gtFine"))
-    files = glob.glob(FILE_PATTERN)
-    if not files:
-        raise RuntimeError("No files in " + os.getcwd() + " found")
-    changes = {}
-    for new_f in progressbar(files):
-        j = read_json(new_f)
-        dump_if_nice(args.data, new_f, j, args.outdir)
\ No newline at end of file
+    index = tl_index.open_index(args.data, args.index)
+    # both overlays of an image are drawn from a single decode
+    store = image_access.ImageStore(args.data, max_bytes=32 * 1024 ** 2)
+    for new_f, rows in progressbar(list(index.iter_files())):
+        dump_if_nice(store, args.data, index, new_f, rows, args.outdir)
\ No newline at end of file
@@ -1,65 +1,28 @@
 #!/usr/bin/env python3
 
-import json
-from enum import Enum, auto
-import glob
 import argparse
-from progressbar import progressbar
-import sys
 import os
-import csv
-import itertools
-from PIL import Image
-import cv2
 from pathlib import Path
 import matplotlib.pyplot as plt
 import functools
 import numpy as np
 import matplotlib.colors as colors
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
-
-LABEL = "traffic light"
-FILE_PATTERN = "./*/*/*gtFine_polygons.json"
+import tl_index
 
 plt.rcParams["font.family"] = "Times New Roman"
 plt.rcParams["font.size"] = "9"
 ODIR = "/tmp/plots"
 SZ = 1024, 2048
 DIS = 8
-
-xg, yg = np.meshgrid(np.linspace(0, SZ[1] / DIS, int(SZ[1] / DIS + 1)), np.linspace(0, SZ[0], int(SZ[0] / DIS + 1)))
-zg = np.zeros_like(xg)
-print(zg.shape)
+LIM = 65
+GROUP_KEYS = ["type", "state", "relevant", "city"]
 
 def ensure_dir(d):
     if os.path.exists(d) and not os.path.isdir(d):
         raise FileExistsError("{} exists and is not a directory".format(d))
     Path(d).mkdir(parents=True, exist_ok=True)
 
-LIM = 65
-
-counts = {l: 0 for l in range(LIM + 2)}
-
-def read_json(fn):
-    with open(fn, "r") as f:
-        data = json.load(f)
-        return data
-
-def get_label(attr):
-    if "type" in attr.keys() and "relevant" in attr.keys():
-        if attr["type"] == "car" and attr["relevant"] == "yes":
-            return "egorel"
-        elif attr["type"]== "car" and attr["relevant"] == "no":
-            return "eogirel"
-        elif attr["type"] == "pedestrian":
-            return "pedestr"
-        elif attr["type"] == "bicycle":
-            return "bike"
-        else:
-            return "other"
-    else:
-        return None
-
 def saver(func):
     @functools.wraps(func)
     def wrapper_decorator(*args, **kwargs):
@@ -77,59 +40,41 @@ def saver(func):
         return value
     return wrapper_decorator
 
-def get_by_label(labels, label):
-    return [obj for obj in labels["objects"] if obj["label"] == label and not ("deleted" in obj.keys() and obj["deleted"])]
-
-def ensure_dir(d):
-    if os.path.exists(d) and not os.path.isdir(d):
-        raise FileExistsError("{} exists and is not a directory".format(d))
-    Path(d).mkdir(parents=True, exist_ok=True)
-
-def get_rect(obj):
-    x,y = list(zip(*obj["polygon"]))
-    return int(max(x)) - int(min(x))
-
-def get_corner(obj):
-    x,y = list(zip(*obj["polygon"]))
-    return int(min(x)), int(min(y))
-
-def write_crop(img, tl, cls, outdir):
-    rect = get_rect(tl)
-    # print(rect)
-    # print(img.shape)
-    crop_img = img[rect[1]:rect[3], rect[0]:rect[2]]
-    out_path = os.path.join(outdir, cls, "{:06d}.png".format(counts[cls]))
-    counts[cls] += 1
-    if crop_img.size > 0:
-        cv2.imwrite(out_path, crop_img)
-
-def dump_if_nice(basedir, f, objects, outdir):
-    tls = get_by_label(objects, LABEL)
-    if len(tls) > 0:
-        imgp = os.path.join(basedir, "leftImg8bit", f)
-        imgp = imgp.replace("gtFine_polygons.json", "leftImg8bit.png")
-        if not os.path.exists(imgp):
-            raise FileNotFoundError("{} does not exist".format(imgp))
-        arr = cv2.imread(imgp)
-        for tl in tls:
-            cls = get_label(tl["attributes"])
-            if cls is not None:
-                write_crop(arr, tl, cls, outdir)
-
-def add_to_statistic(objects):
-    tls = get_by_label(objects, LABEL)
-    if len(tls) > 0:
-        for tl in tls:
-            sz = get_rect(tl)
-            if sz <= LIM:
-                counts[sz] += 1
-            else:
-                counts[LIM + 1] += 1
-            corner = get_corner(tl)
-            zg[int(corner[1] / DIS), int(corner[0] / DIS)] += 1
+def make_grid():
+    return np.meshgrid(np.linspace(0, SZ[1] / DIS, int(SZ[1] / DIS + 1)), np.linspace(0, SZ[0], int(SZ[0] / DIS + 1)))
+
+def width_histogram(bbox):
+    # pixel widths as the int difference of the int corners, everything above LIM lands in the last bin
+    widths = bbox[:, 2].astype(int) - bbox[:, 0].astype(int)
+    return np.bincount(np.clip(widths, 0, LIM + 1), minlength=LIM + 2)
+
+def position_heatmap(bbox):
+    rows, cols = make_grid()[0].shape
+    iy = (bbox[:, 1].astype(int) / DIS).astype(int)
+    ix = (bbox[:, 0].astype(int) / DIS).astype(int)
+    zg, _, _ = np.histogram2d(iy, ix, bins=(np.arange(rows + 1), np.arange(cols + 1)))
+    return zg
+
+def group_values(index, key):
+    if key == "city":
+        cities = np.array([f.split("/")[2] for f in index.files])
+        return cities[index["file"]] if len(index) else np.array([], dtype=str)
+    return index.values(key)
+
+def compute_statistics(index, group_by=(), mask=None):
+    bbox = np.asarray(index["bbox"])
+    if mask is None:
+        mask = np.ones(len(index), dtype=bool)
+    res = {("all", ""): (width_histogram(bbox[mask]), position_heatmap(bbox[mask]))}
+    for key in group_by:
+        vals = group_values(index, key)
+        for val in sorted({v for v in vals[mask]}, key=str):
+            sel = mask & (vals == val)
+            res[(key, str(val))] = (width_histogram(bbox[sel]), position_heatmap(bbox[sel]))
+    return res
 
 @saver
-def make_plot():
+def make_plot(counts):
     ax = plt.gca()
     y = range(1, LIM + 2)
     bars = ax.bar(y, [counts[i] for i in y])
@@ -142,15 +87,13 @@ def make_plot():
     steps.append(66)
     ticks.append(">65")
     plt.xticks(steps, ticks)
-    vals = [counts[i] for i in y]
-    arr = np.array(vals)
-    np.save("/tmp/width_data.npy", arr)
 
 @saver
 def make_heatmap(zg):
+    xg, yg = make_grid()
     ax = plt.gca()
     zg = np.flipud(zg)
-    z_max = zg.max()
+    z_max = max(zg.max(), 1)
     #c = ax.pcolormesh(xg, yg, zg, cmap='Greys', vmin=0, vmax=z_max, norm=colors.LogNorm(vmin=0, vmax=z_max))
     c= ax.pcolormesh(xg, yg, zg, cmap='Greys', norm=colors.LogNorm(vmin=0.1, vmax=z_max))
     # set the limits of the plot to the limits of the data
@@ -169,22 +112,27 @@ def make_heatmap(zg):
     bar = plt.gcf().colorbar(c, cax=axins)
     axins.yaxis.set_ticks_position('left')
 
+def out_name(prefix, key, val):
+    if key == "all":
+        return prefix + ".pdf"
+    return "{}_{}_{}.pdf".format(prefix, key, val.replace(" ", "_"))
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("data")
     #parser.add_argument("outdir", type=str)
+    parser.add_argument("--index", type=str, help="traffic light index, built from data if it does not exist")
+    parser.add_argument("--by", action="append", choices=GROUP_KEYS, default=[], help="additionally plot one breakdown per value of this key")
+    parser.add_argument("--city", action="append", help="only count lights in this city, can be given multiple times")
     args = parser.parse_args()
 
-    os.chdir(os.path.join(args.data, "gtFine"))
-    files = glob.glob(FILE_PATTERN, recursive=True)
-    print(os.getcwd())
-    if not files:
-        raise RuntimeError("No files in " + os.getcwd() + " found")
-    changes = {}
-    for new_f in progressbar(files):
-        j = read_json(new_f)
-        add_to_statistic(j)
-    print(counts)
+    index = tl_index.open_index(args.data, args.index)
+    mask = np.isin(group_values(index, "city"), args.city) if args.city else None
+    stats = compute_statistics(index, args.by, mask)
+    counts = stats[("all", "")][0]
+    print({i: int(c) for i, c in enumerate(counts)})
+    np.save("/tmp/width_data.npy", counts[1:])
     ensure_dir(ODIR)
-    make_plot(sz=(2.3, 1.5), outfile="size.pdf")
-    make_heatmap(zg, sz=(5, 2.2), outfile="scatter.pdf")
\ No newline at end of file
+    for (key, val), (hist, zg) in stats.items():
+        make_plot(hist, sz=(2.3, 1.5), outfile=out_name("size", key, val))
+        make_heatmap(zg, sz=(5, 2.2), outfile=out_name("scatter", key, val))
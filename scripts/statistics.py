@@ -11,6 +11,7 @@ from pathlib import Path
 import os
 import functools
 import numpy as np
+import changeset_io
 
 plt.rcParams["font.family"] = "Times New Roman"
 plt.rcParams["font.size"] = "9"
@@ -158,7 +159,7 @@ if __name__ == "__main__":
     parser.add_argument("changeset")
     args = parser.parse_args()
 
-    data = read_json(args.changeset)
+    data = changeset_io.load(args.changeset)
     ensure_dir(ODIR)
     plot_freq(data, sz=(2.3, 1.5), outfile="freq.pdf")
     plot_overview(data, sz=(2.3, 1.5), outfile="overview.pdf")
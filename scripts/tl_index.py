@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+import json
+import glob
+import argparse
+import os
+import sys
+import shutil
+import tempfile
+import multiprocessing
+from pathlib import Path
+import numpy as np
+from progressbar import progressbar
+
+LABEL = "traffic light"
+FILE_PATTERN = "gtFine/*/*/*gtFine_polygons.json"
+VERSION = 1
+META_FILE = "meta.json"
+ATTR_PREFIX = "attr_"
+COLUMNS = ["file", "obj_idx", "id", "bbox", "centroid", "poly_offsets", "poly_coords", "file_offsets"]
+MISSING = -1
+
+def read_json(fn):
+    with open(fn, "r") as f:
+        data = json.load(f)
+        return data
+
+def ensure_dir(d):
+    if os.path.exists(d) and not os.path.isdir(d):
+        raise FileExistsError("{} exists and is not a directory".format(d))
+    Path(d).mkdir(parents=True, exist_ok=True)
+
+def replace_dir(tmp, path):
+    # a directory can not be replaced in one step, after a crash between both renames path is missing
+    # and gets rebuilt, it never holds a mix of old and new files
+    if os.path.exists(path) and not os.path.isdir(path):
+        raise FileExistsError("{} exists and is not a directory".format(path))
+    # mkdtemp creates the directory private, give it the permissions of a normal mkdir
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp, 0o777 & ~umask)
+    old = None
+    if os.path.exists(path):
+        old = tempfile.mkdtemp(dir=os.path.dirname(path), prefix="." + os.path.basename(path) + ".old.")
+        os.rename(path, os.path.join(old, "index"))
+    os.rename(tmp, path)
+    if old:
+        shutil.rmtree(old)
+
+def get_lights(labels, label=LABEL):
+    return [(idx, obj) for idx, obj in enumerate(labels["objects"]) if obj["label"] == label and not ("deleted" in obj.keys() and obj["deleted"])]
+
+def image_path(data_dir, fn):
+    return os.path.join(data_dir, "leftImg8bit", os.path.relpath(fn, "gtFine")).replace("gtFine_polygons.json", "leftImg8bit.png")
+
+def polygon_centroid(poly):
+    x, y = poly[:, 0], poly[:, 1]
+    xn, yn = np.roll(x, -1), np.roll(y, -1)
+    cross = x * yn - xn * y
+    area = cross.sum() / 2
+    if abs(area) < 1e-9:
+        return poly.mean(axis=0)
+    return np.array([((x + xn) * cross).sum(), ((y + yn) * cross).sum()]) / (6 * area)
+
+def extract_file(data_dir, fn):
+    lights = []
+    for idx, obj in get_lights(read_json(os.path.join(data_dir, fn))):
+        lights.append((idx, int(obj["id"]) if "id" in obj.keys() else MISSING, obj["polygon"], obj.get("attributes", {})))
+    return lights
+
+def _extract_file(task):
+    return extract_file(*task)
+
+def find_files(data_dir, cities=None):
+    files = sorted(os.path.relpath(f, data_dir) for f in glob.glob(os.path.join(data_dir, FILE_PATTERN)))
+    if cities:
+        files = [f for f in files if f.split("/")[2] in cities]
+    return files
+
+def file_mtimes(data_dir, files):
+    return [os.stat(os.path.join(data_dir, f)).st_mtime_ns for f in files]
+
+def value_key(value):
+    return json.dumps(value, sort_keys=True)
+
+def build_index(data_dir, jobs=1, cities=None):
+    files = find_files(data_dir, cities)
+    if not files:
+        raise RuntimeError("No files in " + data_dir + " found")
+    # taken before reading, a file saved during the build makes the index stale instead of silently newer
+    mtimes = file_mtimes(data_dir, files)
+    tasks = [(data_dir, fn) for fn in files]
+    if jobs > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            per_file = list(progressbar(pool.imap(_extract_file, tasks, chunksize=32), max_value=len(tasks)))
+    else:
+        per_file = [_extract_file(t) for t in progressbar(tasks)]
+
+    rows = [(f_i, light) for f_i, lights in enumerate(per_file) for light in lights]
+    n = len(rows)
+    cols = {
+        "file": np.array([f_i for f_i, _ in rows], dtype=np.int32),
+        "obj_idx": np.array([l[0] for _, l in rows], dtype=np.int32),
+        "id": np.array([l[1] for _, l in rows], dtype=np.int32),
+        "bbox": np.zeros((n, 4), dtype=np.float64),
+        "centroid": np.zeros((n, 2), dtype=np.float32),
+        "poly_offsets": np.zeros(n + 1, dtype=np.int64),
+        "file_offsets": np.zeros(len(files) + 1, dtype=np.int64),
+    }
+    cols["file_offsets"][1:] = np.cumsum([len(lights) for lights in per_file])
+    polys = []
+    for i, (_, light) in enumerate(rows):
+        poly = np.asarray(light[2], dtype=np.float64).reshape(-1, 2)
+        polys.append(poly)
+        cols["poly_offsets"][i + 1] = cols["poly_offsets"][i] + len(poly)
+        if len(poly):
+            cols["bbox"][i] = poly[:, 0].min(), poly[:, 1].min(), poly[:, 0].max(), poly[:, 1].max()
+            cols["centroid"][i] = polygon_centroid(poly)
+    cols["poly_coords"] = np.concatenate(polys) if polys else np.zeros((0, 2), dtype=np.float64)
+
+    # attributes are dictionary encoded, one int16 code column per attribute key
+    keys = sorted({k for _, l in rows for k in l[3].keys()})
+    vocab = {k: [] for k in keys}
+    lookup = {k: {} for k in keys}
+    for k in keys:
+        codes = np.full(n, MISSING, dtype=np.int16)
+        for i, (_, light) in enumerate(rows):
+            if k not in light[3]:
+                continue
+            vk = value_key(light[3][k])
+            if vk not in lookup[k]:
+                lookup[k][vk] = len(vocab[k])
+                vocab[k].append(light[3][k])
+            codes[i] = lookup[k][vk]
+        cols[ATTR_PREFIX + k] = codes
+    meta = {"version": VERSION, "files": files, "mtimes": mtimes, "attributes": keys, "vocab": vocab}
+    return TrafficLightIndex(cols, meta)
+
+class TrafficLightIndex():
+    def __init__(self, columns, meta):
+        self._cols = columns
+        self._meta = meta
+        self.files = meta["files"]
+        self.attribute_keys = meta["attributes"]
+        self._lookup = {k: {value_key(v): i for i, v in enumerate(vals)} for k, vals in meta["vocab"].items()}
+
+    @staticmethod
+    def load(path, mmap=True):
+        meta = read_json(os.path.join(path, META_FILE))
+        if meta["version"] != VERSION:
+            raise ValueError("Index {} has version {}, expected {}".format(path, meta["version"], VERSION))
+        names = COLUMNS + [ATTR_PREFIX + k for k in meta["attributes"]]
+        cols = {c: np.load(os.path.join(path, c + ".npy"), mmap_mode="r" if mmap else None) for c in names}
+        return TrafficLightIndex(cols, meta)
+
+    def save(self, path):
+        # written to a temporary directory next to path that replaces it at the end, a crash never
+        # leaves new columns next to an old meta.json
+        path = os.path.abspath(path)
+        ensure_dir(os.path.dirname(path))
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(path), prefix="." + os.path.basename(path) + ".tmp.")
+        try:
+            for name, col in self._cols.items():
+                np.save(os.path.join(tmp, name + ".npy"), col)
+            with open(os.path.join(tmp, META_FILE), "w") as f:
+                json.dump(self._meta, f)
+            replace_dir(tmp, path)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    def __len__(self):
+        return len(self._cols["file"])
+
+    def is_current(self, data_dir):
+        # same label files with the same mtimes, indexes without mtimes are always stale
+        if "mtimes" not in self._meta:
+            return False
+        try:
+            return find_files(data_dir) == self.files and file_mtimes(data_dir, self.files) == self._meta["mtimes"]
+        except OSError:
+            return False
+
+    def __getitem__(self, name):
+        return self._cols[name]
+
+    @property
+    def width(self):
+        return self._cols["bbox"][:, 2] - self._cols["bbox"][:, 0]
+
+    @property
+    def height(self):
+        return self._cols["bbox"][:, 3] - self._cols["bbox"][:, 1]
+
+    def rows_of(self, file_i):
+        return slice(int(self._cols["file_offsets"][file_i]), int(self._cols["file_offsets"][file_i + 1]))
+
+    def counts_per_file(self):
+        return np.diff(self._cols["file_offsets"])
+
+    def iter_files(self, with_lights=True):
+        counts = self.counts_per_file()
+        for f_i, fn in enumerate(self.files):
+            if with_lights and counts[f_i] == 0:
+                continue
+            yield fn, self.rows_of(f_i)
+
+    def code(self, key, value):
+        return self._lookup[key].get(value_key(value), MISSING - 1) if key in self._lookup else MISSING - 1
+
+    def codes(self, key):
+        if key not in self._lookup:
+            return np.full(len(self), MISSING, dtype=np.int16)
+        return self._cols[ATTR_PREFIX + key]
+
+    def vocab(self, key):
+        return self._meta["vocab"].get(key, [])
+
+    def values(self, key):
+        vocab = np.array(self.vocab(key) + [None], dtype=object)
+        return vocab[self.codes(key)]
+
+    def select(self, **attrs):
+        mask = np.ones(len(self), dtype=bool)
+        for key, value in attrs.items():
+            mask &= self.codes(key) == self.code(key, value)
+        return mask
+
+    def attributes(self, row):
+        res = {}
+        for k in self.attribute_keys:
+            code = self._cols[ATTR_PREFIX + k][row]
+            if code != MISSING:
+                res[k] = self._meta["vocab"][k][code]
+        return res
+
+    def polygon(self, row):
+        return self._cols["poly_coords"][self._cols["poly_offsets"][row]:self._cols["poly_offsets"][row + 1]]
+
+def open_index(data_dir, index_dir=None, jobs=1, rebuild=False):
+    if index_dir and not rebuild and os.path.exists(os.path.join(index_dir, META_FILE)):
+        index = TrafficLightIndex.load(index_dir)
+        if index.is_current(data_dir):
+            return index
+        print("Label files changed since {} was built, rebuilding it".format(index_dir), file=sys.stderr)
+    index = build_index(data_dir, jobs)
+    if index_dir:
+        index.save(index_dir)
+    return index
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract all traffic lights of a cityscapes copy into a columnar index")
+    parser.add_argument("data")
+    parser.add_argument("index_dir")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="number of worker processes")
+    args = parser.parse_args()
+
+    index = open_index(args.data, args.index_dir, args.jobs, rebuild=True)
+    print("Indexed {} traffic lights in {} files to {}".format(len(index), len(index.files), args.index_dir))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+from enum import Enum, auto
+import numpy as np
+
+LABEL = "traffic light"
+MISSING = -1
+INVALID = -2
+
+class LabelError(Enum):
+    NO_ATTRIBUTES = auto()
+    MISSING_TAG = auto()
+    INVALID_TAG = auto()
+    MISSING_VALUE = auto()
+    INVALID_VALUE = auto()
+    INVALID_FILE = auto()
+
+class Field():
+    # one attribute, its allowed values are compiled to the codes 0..n-1 in the given order
+    def __init__(self, name, values, required=True, default=None):
+        self.name = name
+        self.values = list(values)
+        self.required = required
+        self.default = default
+        self._codes = {self._key(v): i for i, v in enumerate(self.values)}
+
+    @staticmethod
+    def _key(value):
+        # keeps 1 and True or "1" and 1 apart
+        return type(value), value
+
+    def encode(self, value):
+        try:
+            return self._codes.get(self._key(value), INVALID)
+        except TypeError:
+            return INVALID
+
+    def decode(self, code):
+        return self.values[code]
+
+    def default_for(self, attrs):
+        return self.default(attrs) if callable(self.default) else self.default
+
+# the labelling tool writes all fields, lane_relevant and depth were added there later and are optional
+FIELDS = [
+    Field("relevant", ["yes", "no"], default="no"),
+    Field("state", ["red", "red-yellow", "yellow", "green", "off", "unknown"], default="unknown"),
+    Field("type", ["car", "pedestrian", "bicycle", "train", "bus", "car_warning", "unknown"], default="unknown"),
+    Field("visible", ["yes", "no"], default="no"),
+    Field("lane_relevant", ["yes", "no", "unknown"], required=False, default=lambda attrs: "yes" if attrs.get("relevant") == "yes" else "unknown"),
+    Field("depth", range(5), required=False, default=0),
+]
+FIELD_BY_NAME = {f.name: f for f in FIELDS}
+SCHEMA = {f.name: f.values for f in FIELDS}
+KEYS = sorted(f.name for f in FIELDS if f.required)
+REQUIRED = np.array([f.required for f in FIELDS])
+
+def values(name):
+    return FIELD_BY_NAME[name].values
+
+def is_missing(value):
+    return value is None or value == ""
+
+def encode(attrs):
+    # one int16 code per field, MISSING if absent, INVALID if empty or not allowed
+    codes = np.full(len(FIELDS), MISSING, dtype=np.int16)
+    for i, f in enumerate(FIELDS):
+        if f.name in attrs:
+            codes[i] = f.encode(attrs[f.name])
+    return codes
+
+def encode_many(attr_list):
+    res = np.full((len(attr_list), len(FIELDS)), MISSING, dtype=np.int16)
+    for i, attrs in enumerate(attr_list):
+        res[i] = encode(attrs)
+    return res
+
+def decode(codes):
+    return {f.name: f.decode(int(c)) for f, c in zip(FIELDS, codes) if c >= 0}
+
+def validate_codes(codes):
+    # vectorised check of an (n, len(FIELDS)) code array, returns the valid rows and the per-field error masks
+    codes = np.asarray(codes).reshape(-1, len(FIELDS))
+    missing = (codes == MISSING) & REQUIRED
+    invalid = codes == INVALID
+    return ~(missing | invalid).any(axis=1), missing, invalid
+
+def from_index(index):
+    # schema codes of all lights in a tl_index, translated from the index vocabularies with lookup tables
+    codes = np.full((len(index), len(FIELDS)), MISSING, dtype=np.int16)
+    for i, f in enumerate(FIELDS):
+        if f.name not in index.attribute_keys:
+            continue
+        # the last entry catches the index's MISSING code
+        table = np.array([f.encode(v) for v in index.vocab(f.name)] + [MISSING], dtype=np.int16)
+        codes[:, i] = table[index.codes(f.name)]
+    return codes
+
+def unknown_keys(attrs):
+    return [k for k in attrs.keys() if k not in FIELD_BY_NAME]
+
+def check_attr_map(attrs):
+    errs = []
+    for k in sorted(attrs.keys()):
+        if k not in FIELD_BY_NAME:
+            errs.append((LabelError.INVALID_TAG, k))
+    for k in KEYS:
+        if k not in attrs:
+            errs.append((LabelError.MISSING_TAG, k))
+    for k in sorted(FIELD_BY_NAME):
+        if k not in attrs:
+            continue
+        if is_missing(attrs[k]):
+            errs.append((LabelError.MISSING_VALUE, (k, attrs[k])))
+        elif FIELD_BY_NAME[k].encode(attrs[k]) == INVALID:
+            errs.append((LabelError.INVALID_VALUE, (k, attrs[k])))
+    return errs
+
+def check_attributes(obj):
+    if not "attributes" in obj.keys():
+        return [(LabelError.NO_ATTRIBUTES, None)]
+    return check_attr_map(obj["attributes"])
+
+def is_valid(attrs):
+    codes = encode(attrs)
+    return not unknown_keys(attrs) and bool(validate_codes(codes)[0][0])
+
+def fill_defaults(attrs):
+    # adds the default of every missing field, the order matters for derived defaults like lane_relevant
+    for f in FIELDS:
+        if f.name not in attrs:
+            attrs[f.name] = f.default_for(attrs)
+    return attrs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the schema or validate a traffic light index against it")
+    parser.add_argument("--index", type=str, help="traffic light index to validate")
+    args = parser.parse_args()
+
+    if not args.index:
+        print(json.dumps({f.name: {"values": f.values, "required": f.required} for f in FIELDS}, indent=4))
+    else:
+        import tl_index
+        index = tl_index.TrafficLightIndex.load(args.index)
+        valid, missing, invalid = validate_codes(from_index(index))
+        print("{} of {} lights valid".format(int(valid.sum()), len(valid)))
+        for i, f in enumerate(FIELDS):
+            if missing[:, i].any() or invalid[:, i].any():
+                print("  {}: {} missing, {} invalid".format(f.name, int(missing[:, i].sum()), int(invalid[:, i].sum())))